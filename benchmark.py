@@ -5,7 +5,7 @@ import re
 import sqlite3
 from collections import OrderedDict
 from datetime import datetime
-from random import choice
+from random import choice, sample, shuffle
 from subprocess import check_output
 from time import time
 
@@ -19,14 +19,18 @@ import psycopg2
 from django.conf import settings
 from django.contrib.auth.models import Group, User
 from django.core.cache import caches
-from django.db import connection, connections
+from django.db import connection, connections, transaction
+from django.db.models import Q
 from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils.encoding import force_text
 from MySQLdb import _mysql
 
 import cachalot
 from cachalot.api import invalidate
+from cachalot.settings import cachalot_settings
 from cachalot.tests.models import Test
+from cachalot.utils import (
+    get_normalized_query_cache_key, get_query_cache_key)
 
 
 RESULTS_PATH = f"benchmark/docs/{datetime.now().date()}/"
@@ -328,6 +332,89 @@ class Benchmark(object):
         plt.savefig(os.path.join(RESULTS_PATH, "%s.svg" % param))
 
 
+def nested_atomic(using, depth, read):
+    if not depth:
+        if read:
+            list(Test.objects.using(using)[:10])
+        return
+    with transaction.atomic(using=using):
+        nested_atomic(using, depth - 1, read)
+
+
+class AtomicBenchmark(object):
+    n = 20
+    depth = 100
+
+    def bench_once(self, read):
+        start = time()
+        for _ in range(self.n):
+            nested_atomic(self.db_alias, self.depth, read)
+        return (time() - start) / self.n
+
+    def run(self):
+        with io.open(os.path.join(RESULTS_PATH, "atomic_results.rst"), "w") as f:
+            for db_alias in settings.DATABASES:
+                self.db_alias = db_alias
+                db_vendor = connections[self.db_alias].vendor
+                print("Benchmarking nested atomic blocks on %s…" % db_vendor)
+                for read in (False, True):
+                    cachalot_settings.unload()
+                    control = self.bench_once(read)
+                    cachalot_settings.load()
+                    invalidate(db_alias=self.db_alias)
+                    cached = self.bench_once(read)
+                    perf = "%s %d nested atomic blocks%s: %.1f× %s" % (
+                        db_vendor.ljust(10),
+                        self.depth,
+                        " with a read" if read else "",
+                        max(control, cached) / min(control, cached),
+                        "faster" if cached < control else "slower",
+                    )
+                    print(perf)
+                    f.write("- %s\n" % perf)
+
+
+class KeyReuseBenchmark(object):
+    n = 1000
+    n_ids = 8
+
+    def get_querysets(self, using):
+        ids = list(Test.objects.using(using).values_list("pk", flat=True)[
+            : self.n_ids
+        ])
+        for _ in range(self.n):
+            filters = [
+                Q(pk__in=sample(ids, 3)),
+                Q(public=False),
+                Q(name__startswith="test"),
+            ]
+            shuffle(filters)
+            qs = Test.objects.using(using)
+            for q in filters:
+                qs = qs.filter(q)
+            yield qs
+
+    def run(self):
+        with io.open(os.path.join(RESULTS_PATH, "key_reuse_results.rst"), "w") as f:
+            for db_alias in settings.DATABASES:
+                db_vendor = connections[db_alias].vendor
+                print("Benchmarking cache key reuse on %s…" % db_vendor)
+                querysets = list(self.get_querysets(db_alias))
+                for keygen in (get_query_cache_key, get_normalized_query_cache_key):
+                    keys = {
+                        keygen(qs.query.get_compiler(db_alias)) for qs in querysets
+                    }
+                    perf = "%s %s: %d cache keys for %d queries, %.1f%% reused" % (
+                        db_vendor.ljust(10),
+                        keygen.__name__.ljust(30),
+                        len(keys),
+                        len(querysets),
+                        100 * (1 - len(keys) / len(querysets)),
+                    )
+                    print(perf)
+                    f.write("- %s\n" % perf)
+
+
 def create_data(using):
     User.objects.using(using).bulk_create(
         [User(username="user%d" % i) for i in range(50)]
@@ -360,6 +447,8 @@ if __name__ == "__main__":
         create_data(alias)
 
     Benchmark().run()
+    AtomicBenchmark().run()
+    KeyReuseBenchmark().run()
 
     for alias in connections:
         connections[alias].creation.destroy_test_db(old_db_names[alias])
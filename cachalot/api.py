@@ -2,13 +2,19 @@ from contextlib import contextmanager
 
 from django.apps import apps
 from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.db import connections
+from django.db.models import Manager, QuerySet
 
 from .cache import cachalot_caches
 from .settings import cachalot_settings
 from .signals import post_invalidation
 from .transaction import AtomicCache
-from .utils import _invalidate_tables
+from .utils import (
+    CACHABLE_PARAM_TYPES, PARAM_ENCODERS,
+    _get_fragment_invalidation_keys, _get_table_invalidation_keys,
+    _invalidate_cache_keys, _invalidate_tables, filter_cachable,
+)
 
 
 try:
@@ -19,7 +25,10 @@ except ImportError:
     LOCAL_STORAGE = threading.local()
 
 
-__all__ = ('invalidate', 'get_last_invalidation', 'cachalot_disabled')
+__all__ = ('invalidate', 'get_last_invalidation', 'cachalot_disabled',
+           'cachalot_deferred_invalidations', 'cachalot_bulk_writes',
+           'fetch_many', 'register_param_type',
+           'CachalotQuerySetMixin', 'CachalotQuerySet', 'CachalotManager')
 
 
 def _cache_db_tables_iterator(tables, cache_alias, db_alias):
@@ -79,8 +88,14 @@ def invalidate(*tables_or_models, **kwargs):
     invalidated = set()
     for cache_alias, db_alias, tables in _cache_db_tables_iterator(
             list(_get_tables(tables_or_models)), cache_alias, db_alias):
+        cache_alias = cachalot_caches.get_table_cache_alias(cache_alias)
         cache = cachalot_caches.get_cache(cache_alias, db_alias)
         if not isinstance(cache, AtomicCache):
+            if cachalot_caches.deferral_depth:
+                cachalot_caches.defer_invalidation(
+                    cache_alias, db_alias, _get_table_invalidation_keys(
+                        db_alias, filter_cachable(set(tables))))
+                continue
             send_signal = True
         _invalidate_tables(cache, db_alias, tables)
         invalidated.update(tables)
@@ -90,6 +105,24 @@ def invalidate(*tables_or_models, **kwargs):
             post_invalidation.send(table, db_alias=db_alias)
 
 
+def _invalidate_fragments(table, fragments, cache_alias, db_alias):
+    """
+    Invalidates ``fragments`` of ``table``, for tables
+    of ``CACHALOT_ROW_LEVEL_TABLES``, ``CACHALOT_PARTITION_COLUMNS``
+    or ``CACHALOT_COLUMN_LEVEL_TABLES``.
+    """
+    keys = _get_fragment_invalidation_keys(db_alias, table, fragments)
+    cache_alias = cachalot_caches.get_table_cache_alias(cache_alias)
+    cache = cachalot_caches.get_cache(cache_alias, db_alias)
+    if isinstance(cache, AtomicCache):
+        _invalidate_cache_keys(cache, keys)
+    elif cachalot_caches.deferral_depth:
+        cachalot_caches.defer_invalidation(cache_alias, db_alias, keys)
+    else:
+        _invalidate_cache_keys(cache, keys)
+        post_invalidation.send(table, db_alias=db_alias)
+
+
 def get_last_invalidation(*tables_or_models, **kwargs):
     """
     Returns the timestamp of the most recent invalidation of the given
@@ -122,8 +155,12 @@ def get_last_invalidation(*tables_or_models, **kwargs):
     last_invalidation = 0.0
     for cache_alias, db_alias, tables in _cache_db_tables_iterator(
             list(_get_tables(tables_or_models)), cache_alias, db_alias):
+        cache_alias = cachalot_caches.get_table_cache_alias(cache_alias)
         get_table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN
         table_cache_keys = [get_table_cache_key(db_alias, t) for t in tables]
+        if cachalot_caches.deferral_depth:
+            cachalot_caches.flush_deferred_invalidations(
+                cache_alias, db_alias, table_cache_keys)
         invalidations = cachalot_caches.get_cache(
             cache_alias, db_alias).get_many(table_cache_keys).values()
         if invalidations:
@@ -167,3 +204,242 @@ def cachalot_disabled(all_queries=False):
     LOCAL_STORAGE.disable_on_all = all_queries
     yield
     LOCAL_STORAGE.enabled = was_enabled
+
+
+@contextmanager
+def cachalot_deferred_invalidations():
+    """
+    Context manager for coalescing invalidations.
+
+    Outside of atomic blocks, each write normally invalidates its tables
+    with its own cache round trip.  Inside this context manager,
+    the invalidated tables are only accumulated in memory, then invalidated
+    with a single ``set_many`` per cache and database when exiting
+    the outermost ``cachalot_deferred_invalidations``.  If a query reading
+    one of these tables is executed in the meantime, the pending
+    invalidations of this query are applied immediately before it,
+    so the current thread never reads stale data.
+
+    Other threads and processes only see these invalidations when they are
+    applied, so only use this around short units of work
+    like a request or a task.  It can also be used as a decorator.
+
+    For example:
+
+    .. code-block:: python
+
+        with cachalot_deferred_invalidations():
+            for obj in objects:
+                obj.save()  # No cache write
+        # A single cache write happened here.
+    """
+    cachalot_caches.enter_deferral()
+    try:
+        yield
+    finally:
+        cachalot_caches.exit_deferral()
+
+
+@contextmanager
+def cachalot_bulk_writes(*tables_or_models, db_alias=None):
+    """
+    Context manager for large batches of writes, typically in management
+    commands or tasks loading data.
+
+    Inside it, writes do not invalidate anything: django-cachalot only
+    remembers the tables written using the ORM, and the databases receiving
+    raw SQL writes, without parsing these raw queries.  Queries reading
+    a written table are not cached until the end of the block.
+    When exiting the outermost ``cachalot_bulk_writes``, a single
+    invalidation is done per database for the written and declared tables.
+
+    Raw SQL writes are assumed to only modify the declared
+    ``tables_or_models``.  If no table is declared for a database, a raw
+    SQL write invalidates all its tables at the end of the block.
+    Declared tables are always invalidated, even if no write was detected,
+    as it happens with ``COPY`` through ``cursor.copy_expert``.
+
+    :arg tables_or_models: SQL tables names, models or models lookups
+                           (or a combination) written using raw SQL
+    :type tables_or_models: tuple of strings or models
+    :arg db_alias: Alias from the Django ``DATABASES`` setting where
+                   ``tables_or_models`` are written, otherwise they are
+                   considered as written in all databases
+    :type db_alias: string or NoneType
+    """
+    db_aliases = settings.DATABASES if db_alias is None else (db_alias,)
+    cachalot_caches.enter_bulk_writes(
+        db_aliases, set(_get_tables(tables_or_models)))
+    try:
+        yield
+    finally:
+        written = cachalot_caches.exit_bulk_writes()
+        for written_db_alias, tables in written.items():
+            invalidate(*(tables or ()), db_alias=written_db_alias,
+                       cache_alias=cachalot_settings.CACHALOT_CACHE)
+
+
+def fetch_many(*querysets):
+    """
+    Evaluates ``querysets`` with a single cache lookup per cache,
+    instead of one per SQL query.  The SQL queries that are not cached
+    are then executed, and their results are cached with a single
+    cache write per cache.
+
+    For example:
+
+    .. code-block:: python
+
+        users, groups = fetch_many(User.objects.all(), Group.objects.all())
+
+    Only the main SQL query of each queryset is fetched in a batch,
+    ``prefetch_related`` queries still have their own cache lookups.
+
+    :arg querysets: Querysets to evaluate
+    :type querysets: tuple of QuerySet
+    :returns: The list of the results of each queryset
+    :rtype: list of lists
+    """
+    # We import this here to avoid a circular import issue.
+    from .monkey_patch import _get_query_cache_keys
+
+    keys_per_cache = {}
+    keys_per_query = {}
+    if cachalot_settings.CACHALOT_ENABLED:
+        for queryset in querysets:
+            if queryset._result_cache is not None:
+                continue
+            compiler = queryset.query.get_compiler(queryset.db)
+            keys = _get_query_cache_keys(compiler)
+            if keys is None:
+                continue
+            cache_key, table_cache_keys = keys
+            cache = cachalot_caches.get_cache(
+                db_alias=compiler.using, tables=table_cache_keys.values())
+            table_cache = cachalot_caches.get_table_cache(
+                db_alias=compiler.using)
+            keys_per_cache.setdefault(id(cache), (cache, set()))[1].add(
+                cache_key)
+            keys_per_cache.setdefault(id(table_cache), (table_cache, set()))[
+                1].update(table_cache_keys)
+            keys_per_query[cache_key] = list(table_cache_keys) + [cache_key]
+
+    data = {}
+    for cache, keys in keys_per_cache.values():
+        data.update(cache.get_many(list(keys)))
+    fetched = {cache_key: {k: data[k] for k in keys if k in data}
+               for cache_key, keys in keys_per_query.items()}
+
+    cachalot_caches.enter_batch(fetched)
+    try:
+        return [list(queryset) for queryset in querysets]
+    finally:
+        cachalot_caches.exit_batch()
+
+
+def register_param_type(param_type, encoder=str):
+    """
+    Allows caching SQL queries with parameters of class ``param_type``,
+    like the adapters of custom fields.  By default, SQL queries
+    with parameters of other classes than the built-in ones are not cached.
+
+    ``encoder`` gives the string representing a parameter in cache keys.
+    Parameters represented by the same string must give the same
+    results, so ``encoder`` must be changed if ``str`` does not include
+    all their data.
+
+    For example:
+
+    .. code-block:: python
+
+        register_param_type(Money, lambda m: '%s %s' % (m.amount, m.currency))
+
+    Run ``./manage.py invalidate_cachalot`` after changing an encoder.
+
+    :arg param_type: Class of the parameters
+    :type param_type: type
+    :arg encoder: Function returning the string representing a parameter
+    :type encoder: callable
+    :returns: Nothing
+    :rtype: NoneType
+    """
+    CACHABLE_PARAM_TYPES.add(param_type)
+    if encoder is str:
+        PARAM_ENCODERS.pop(param_type, None)
+    else:
+        PARAM_ENCODERS[param_type] = encoder
+
+
+class CachalotQuerySetMixin:
+    """
+    Mixin adding django-cachalot options to a ``QuerySet`` class.
+    If your models do not already use a custom ``QuerySet``,
+    use ``CachalotQuerySet`` or ``CachalotManager`` instead.
+
+    For example:
+
+    .. code-block:: python
+
+        class Country(models.Model):
+            ...
+            objects = CachalotManager()
+
+        Country.objects.cachalot(timeout=86400).get(code='FR')
+        Country.objects.nocache().filter(population__gt=10 ** 6)
+    """
+
+    def cachalot(self, enabled=None, timeout=DEFAULT_TIMEOUT, refresh=None,
+                 stale=None):
+        """
+        Returns a new queryset caching its results with these options.
+        Options that are not specified keep their previous value.
+
+        :arg enabled: If set to ``False``, the SQL queries of this queryset
+                      are neither read from nor stored in the cache
+        :type enabled: bool or NoneType
+        :arg timeout: Number of seconds during which the results are cached,
+                      instead of ``CACHALOT_TIMEOUT``
+                      or ``CACHALOT_TABLE_TIMEOUTS``
+        :type timeout: int or NoneType
+        :arg refresh: If set to ``True``, the SQL queries are executed
+                      even if their results are cached,
+                      then their results are cached again
+        :type refresh: bool or NoneType
+        :arg stale: Maximum age in seconds of a cached result
+                    still used after its tables were invalidated
+        :type stale: int or float or NoneType
+        :returns: A new queryset
+        :rtype: QuerySet
+        """
+        clone = self._chain()
+        # Options are replaced and not updated, since cloned queries
+        # share the same dict.
+        options = getattr(clone.query, 'cachalot_options', {}).copy()
+        if enabled is not None:
+            options['enabled'] = enabled
+        if timeout is not DEFAULT_TIMEOUT:
+            options['timeout'] = timeout
+        if refresh is not None:
+            options['refresh'] = refresh
+        if stale is not None:
+            options['stale'] = stale
+        clone.query.cachalot_options = options
+        return clone
+
+    def nocache(self):
+        """
+        Returns a new queryset whose SQL queries are not cached,
+        a shortcut for ``cachalot(enabled=False)``.
+
+        :returns: A new queryset
+        :rtype: QuerySet
+        """
+        return self.cachalot(enabled=False)
+
+
+class CachalotQuerySet(CachalotQuerySetMixin, QuerySet):
+    pass
+
+
+class CachalotManager(Manager.from_queryset(CachalotQuerySet)):
+    pass
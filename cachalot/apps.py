@@ -24,15 +24,21 @@ def check_django_version(app_configs, **kwargs):
 
 @register(Tags.caches, Tags.compatibility)
 def check_cache_compatibility(app_configs, **kwargs):
-    cache = settings.CACHES[cachalot_settings.CACHALOT_CACHE]
-    cache_backend = cache['BACKEND']
-    if cache_backend not in SUPPORTED_CACHE_BACKENDS:
-        return [Warning(
-            'Cache backend %r is not supported by django-cachalot.'
-            % cache_backend,
-            hint='Switch to a supported cache backend '
-                 'like Redis or Memcached.',
-            id='cachalot.W001')]
+    cache_aliases = [cachalot_settings.CACHALOT_CACHE]
+    if cachalot_settings.CACHALOT_TABLE_CACHE is not None:
+        cache_aliases.append(cachalot_settings.CACHALOT_TABLE_CACHE)
+    cache_aliases.extend(
+        set(cachalot_settings.CACHALOT_RESULT_CACHES.values()))
+    cache_aliases.extend(cachalot_settings.CACHALOT_CACHE_SHARDS)
+    for cache_alias in cache_aliases:
+        cache_backend = settings.CACHES[cache_alias]['BACKEND']
+        if cache_backend not in SUPPORTED_CACHE_BACKENDS:
+            return [Warning(
+                'Cache backend %r is not supported by django-cachalot.'
+                % cache_backend,
+                hint='Switch to a supported cache backend '
+                     'like Redis or Memcached.',
+                id='cachalot.W001')]
     return []
 
 
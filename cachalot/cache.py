@@ -1,56 +1,465 @@
+import logging
+from bisect import bisect
 from collections import defaultdict
-from threading import local
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import md5
+from threading import local, Lock
 
 from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.db import DEFAULT_DB_ALIAS
+from django.db.transaction import on_commit
 
 from .settings import cachalot_settings
 from .signals import post_invalidation
 from .transaction import AtomicCache
+from .utils import (
+    _get_table_invalidation_keys, _invalidate_cache_keys, _set_many)
+
+
+logger = logging.getLogger(__name__)
+
+
+def commit_atomic_caches(db_alias, atomic_caches):
+    to_be_invalidated = set()
+    for atomic_cache in atomic_caches:
+        # Django caches are thread-local, and this may run in a thread
+        # of `CACHALOT_COMMIT_EXECUTOR`.
+        atomic_cache.commit(
+            cachalot_caches.get_backend(atomic_cache.cache_alias))
+        to_be_invalidated.update(atomic_cache.to_be_invalidated.values())
+    for table in to_be_invalidated:
+        post_invalidation.send(table, db_alias=db_alias)
+
+
+def _get_ring_position(key):
+    return int.from_bytes(md5(key.encode()).digest()[:8], 'big')
+
+
+class ShardedCache(object):
+    """
+    Distributes keys across the caches of ``cache_aliases`` using
+    a consistent hash ring, so that adding or removing a cache only moves
+    the keys of its neighbours on the ring.
+
+    Only implements the cache methods used by django-cachalot.
+    The keys of a multi-key operation are grouped per cache, one group
+    is sent by the calling thread and the others in parallel by a pool
+    of ``max_workers`` threads shared by the whole process.
+    """
+
+    points_per_cache = 160
+
+    def __init__(self, cache_aliases, max_workers=None):
+        self.cache_aliases = tuple(cache_aliases)
+        ring = sorted(
+            (_get_ring_position('%s-%d' % (cache_alias, i)), cache_alias)
+            for cache_alias in self.cache_aliases
+            for i in range(self.points_per_cache))
+        self.positions = [position for position, _ in ring]
+        self.ring = [cache_alias for _, cache_alias in ring]
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def get_cache_alias(self, key):
+        i = bisect(self.positions, _get_ring_position(key))
+        return self.ring[i % len(self.ring)]
+
+    def _map(self, method, keys_per_cache_alias, *args):
+        """
+        Calls ``method`` of each cache with its keys,
+        then returns the results.
+        """
+        # Django caches are thread-local, so they are fetched
+        # in the thread using them.
+        call = lambda item: getattr(caches[item[0]], method)(item[1], *args)
+        items = list(keys_per_cache_alias.items())
+        if not items:
+            return []
+        futures = [self.executor.submit(call, item) for item in items[1:]]
+        results = [call(items[0])]
+        results.extend(future.result() for future in futures)
+        return results
+
+    def _group(self, keys):
+        keys_per_cache_alias = defaultdict(list)
+        for k in keys:
+            keys_per_cache_alias[self.get_cache_alias(k)].append(k)
+        return keys_per_cache_alias
+
+    def get(self, key, default=None):
+        return caches[self.get_cache_alias(key)].get(key, default)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        caches[self.get_cache_alias(key)].set(key, value, timeout)
+
+    def delete(self, key):
+        return caches[self.get_cache_alias(key)].delete(key)
+
+    def get_many(self, keys):
+        data = {}
+        for cache_data in self._map('get_many', self._group(keys)):
+            data.update(cache_data)
+        return data
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT):
+        data_per_cache_alias = defaultdict(dict)
+        for k, v in data.items():
+            data_per_cache_alias[self.get_cache_alias(k)][k] = v
+        failed_keys = []
+        for cache_failed_keys in self._map('set_many', data_per_cache_alias,
+                                           timeout):
+            failed_keys.extend(cache_failed_keys or ())
+        return failed_keys
+
+    def delete_many(self, keys):
+        self._map('delete_many', self._group(keys))
+
+    def clear(self):
+        for cache_alias in self.cache_aliases:
+            caches[cache_alias].clear()
+
+
+SHARDED_CACHES = {}
+
+
+def get_sharded_cache(cache_aliases, max_workers=None):
+    key = (tuple(cache_aliases), max_workers)
+    sharded_cache = SHARDED_CACHES.get(key)
+    if sharded_cache is None:
+        sharded_cache = SHARDED_CACHES[key] = ShardedCache(
+            cache_aliases, max_workers)
+    return sharded_cache
+
+
+class FrequencySketch(object):
+    """
+    Count-min sketch estimating how often keys are added,
+    keeping track of the ``size`` most frequent ones.
+
+    Counters are halved every ``10 * width`` additions,
+    so that keys stop being hot once they are not read anymore.
+    A key is only hot once its estimate reaches ``min_count``,
+    and once there are ``size`` hot keys, only if it beats
+    the coldest of them.
+    """
+
+    depth = 4
+    min_count = 2
+
+    def __init__(self, size, width=1024):
+        self.size = size
+        self.width = width
+        self.counters = [[0] * width for _ in range(self.depth)]
+        self.hot_keys = {}
+        self.additions = 0
+        self.lock = Lock()
+
+    def _get_indexes(self, key):
+        digest = md5(key.encode()).digest()
+        return [int.from_bytes(digest[i * 4:i * 4 + 4], 'big') % self.width
+                for i in range(self.depth)]
+
+    def add(self, key):
+        indexes = self._get_indexes(key)
+        with self.lock:
+            for row, i in zip(self.counters, indexes):
+                row[i] += 1
+            count = min(row[i] for row, i in zip(self.counters, indexes))
+            hot_keys = self.hot_keys
+            if key in hot_keys:
+                hot_keys[key] = count
+            elif count < self.min_count:
+                pass
+            elif len(hot_keys) < self.size:
+                hot_keys[key] = count
+            else:
+                coldest_key = min(hot_keys, key=hot_keys.get)
+                if count > hot_keys[coldest_key]:
+                    del hot_keys[coldest_key]
+                    hot_keys[key] = count
+            self.additions += 1
+            if self.additions >= 10 * self.width:
+                self.additions = 0
+                self.counters = [[c >> 1 for c in row]
+                                 for row in self.counters]
+                self.hot_keys = {k: c >> 1 for k, c in hot_keys.items()}
+
+    def is_hot(self, key):
+        return key in self.hot_keys
+
+
+FREQUENCY_SKETCHES = {}
+
+
+def get_frequency_sketch(size):
+    sketch = FREQUENCY_SKETCHES.get(size)
+    if sketch is None:
+        sketch = FREQUENCY_SKETCHES[size] = FrequencySketch(size)
+    return sketch
 
 
 class CacheHandler(local):
+    deferral_depth = 0
+    bulk_depth = 0
+    batch_fetched = None
+    batch_pending = None
+    prefetch_timestamps = None
+    prefetch_table_cache_keys = ()
+    derived_from = None
+
     @property
     def atomic_caches(self):
         if not hasattr(self, '_atomic_caches'):
-            self._atomic_caches = defaultdict(list)
+            self._atomic_caches = defaultdict(dict)
         return self._atomic_caches
 
-    def get_atomic_cache(self, cache_alias, db_alias, level):
-        if cache_alias not in self.atomic_caches[db_alias][level]:
-            self.atomic_caches[db_alias][level][cache_alias] = AtomicCache(
-                self.get_cache(cache_alias, db_alias, level-1), db_alias)
-        return self.atomic_caches[db_alias][level][cache_alias]
+    @property
+    def atomic_depths(self):
+        if not hasattr(self, '_atomic_depths'):
+            self._atomic_depths = defaultdict(int)
+        return self._atomic_depths
+
+    @property
+    def deferred_invalidations(self):
+        if not hasattr(self, '_deferred_invalidations'):
+            self._deferred_invalidations = defaultdict(dict)
+        return self._deferred_invalidations
 
-    def get_cache(self, cache_alias=None, db_alias=None, atomic_level=-1):
+    def get_cache(self, cache_alias=None, db_alias=None, tables=None):
         if db_alias is None:
             db_alias = DEFAULT_DB_ALIAS
         if cache_alias is None:
-            cache_alias = cachalot_settings.CACHALOT_CACHE
+            cache_alias = self.get_result_cache_alias(tables)
+
+        depth = self.atomic_depths[db_alias]
+        if not depth:
+            return self.get_backend(cache_alias)
+        # A single atomic cache is used for the whole transaction,
+        # it is only created when cachalot is used in this transaction.
+        atomic_caches = self.atomic_caches[db_alias]
+        atomic_cache = atomic_caches.get(cache_alias)
+        if atomic_cache is None:
+            atomic_cache = atomic_caches[cache_alias] = AtomicCache(
+                self.get_backend(cache_alias), cache_alias, db_alias, depth)
+        return atomic_cache
 
-        min_level = -len(self.atomic_caches[db_alias])
-        if atomic_level < min_level:
-            return caches[cache_alias]
-        return self.get_atomic_cache(cache_alias, db_alias, atomic_level)
+    def get_backend(self, cache_alias):
+        """
+        Returns the cache of ``cache_alias``, or the caches of
+        ``CACHALOT_CACHE_SHARDS`` when it is ``CACHALOT_CACHE``.
+        """
+        shards = cachalot_settings.CACHALOT_CACHE_SHARDS
+        if shards and cache_alias == cachalot_settings.CACHALOT_CACHE:
+            return get_sharded_cache(
+                shards, cachalot_settings.CACHALOT_CACHE_SHARD_WORKERS)
+        return caches[cache_alias]
+
+    def get_result_cache_alias(self, tables=None):
+        """
+        Returns the alias of the cache storing the results of queries
+        reading ``tables``, according to ``CACHALOT_RESULT_CACHES``.
+        """
+        result_caches = cachalot_settings.CACHALOT_RESULT_CACHES
+        if result_caches and tables:
+            cache_aliases = {result_caches[t] for t in tables
+                             if t in result_caches}
+            if len(cache_aliases) == 1:
+                return cache_aliases.pop()
+        return cachalot_settings.CACHALOT_CACHE
+
+    def get_table_cache_alias(self, cache_alias=None):
+        """
+        Returns the alias of the cache storing the table cache keys
+        of the query results stored in ``cache_alias``.
+        """
+        cachalot_cache_alias = cachalot_settings.CACHALOT_CACHE
+        if cache_alias is None \
+                or cache_alias == cachalot_cache_alias \
+                or cache_alias in \
+                cachalot_settings.CACHALOT_RESULT_CACHES.values():
+            # Results of `CACHALOT_RESULT_CACHES` use the same table
+            # cache keys as those of `CACHALOT_CACHE`.
+            table_cache_alias = cachalot_settings.CACHALOT_TABLE_CACHE
+            if table_cache_alias is None:
+                return cachalot_cache_alias
+            return table_cache_alias
+        return cache_alias
+
+    def get_table_cache(self, cache_alias=None, db_alias=None):
+        return self.get_cache(self.get_table_cache_alias(cache_alias),
+                              db_alias)
 
     def enter_atomic(self, db_alias):
         if db_alias is None:
             db_alias = DEFAULT_DB_ALIAS
-        self.atomic_caches[db_alias].append({})
+        self.atomic_depths[db_alias] += 1
+        for atomic_cache in self.atomic_caches[db_alias].values():
+            atomic_cache.enter_atomic()
+
+    def pop_atomic_caches(self, db_alias, commit):
+        """
+        Exits the innermost atomic level.  When it is the outermost one,
+        returns the atomic caches containing data to commit.
+        """
+        self.atomic_depths[db_alias] -= 1
+        if self.atomic_depths[db_alias]:
+            for atomic_cache in self.atomic_caches[db_alias].values():
+                atomic_cache.exit_atomic(commit)
+            return []
+        atomic_caches = self.atomic_caches.pop(db_alias, {}).values()
+        for atomic_cache in atomic_caches:
+            if atomic_cache.peak_results:
+                logger.debug(
+                    'Transaction on database %r kept up to %d query results '
+                    'in memory for cache %r (%d evicted).',
+                    db_alias, atomic_cache.peak_results,
+                    atomic_cache.cache_alias, atomic_cache.evictions)
+        if not commit:
+            return []
+        return [atomic_cache for atomic_cache in atomic_caches
+                if atomic_cache or atomic_cache.to_be_invalidated]
 
     def exit_atomic(self, db_alias, commit):
         if db_alias is None:
             db_alias = DEFAULT_DB_ALIAS
-        atomic_caches = self.atomic_caches[db_alias].pop().values()
-        if commit:
-            to_be_invalidated = set()
-            for atomic_cache in atomic_caches:
-                atomic_cache.commit()
-                to_be_invalidated.update(atomic_cache.to_be_invalidated)
-            # This happens when committing the outermost atomic block.
-            if not self.atomic_caches[db_alias]:
-                for table in to_be_invalidated:
-                    post_invalidation.send(table, db_alias=db_alias)
+        commit_atomic_caches(db_alias,
+                             self.pop_atomic_caches(db_alias, commit))
+
+    def is_outermost_atomic(self, db_alias):
+        if db_alias is None:
+            db_alias = DEFAULT_DB_ALIAS
+        return self.atomic_depths[db_alias] == 1
+
+    def exit_atomic_on_commit(self, db_alias, executor):
+        """
+        Exits the outermost atomic block, like ``exit_atomic``, except that
+        its data is sent to the cache by ``executor`` once the transaction
+        is successfully committed.
+        """
+        if db_alias is None:
+            db_alias = DEFAULT_DB_ALIAS
+        atomic_caches = self.pop_atomic_caches(db_alias, True)
+        if atomic_caches:
+            on_commit(lambda: executor(partial(
+                commit_atomic_caches, db_alias, atomic_caches)),
+                using=db_alias)
+
+    def enter_deferral(self):
+        self.deferral_depth += 1
+
+    def exit_deferral(self):
+        self.deferral_depth -= 1
+        if not self.deferral_depth:
+            for cache_alias, db_alias in list(self.deferred_invalidations):
+                self.flush_deferred_invalidations(cache_alias, db_alias)
+
+    def defer_invalidation(self, cache_alias, db_alias, keys):
+        self.deferred_invalidations[cache_alias, db_alias].update(keys)
+
+    def flush_deferred_invalidations(self, cache_alias, db_alias,
+                                     table_cache_keys=None):
+        pending = self.deferred_invalidations.get((cache_alias, db_alias))
+        if not pending:
+            return
+        if table_cache_keys is None:
+            keys = pending.copy()
+            pending.clear()
+        else:
+            keys = {k: pending.pop(k) for k in table_cache_keys
+                    if k in pending}
+            if not keys:
+                return
+        # Deferred tables were written outside any atomic block,
+        # so they are invalidated directly on the real cache.
+        _invalidate_cache_keys(self.get_backend(cache_alias), keys)
+        for table in set(keys.values()):
+            post_invalidation.send(table, db_alias=db_alias)
+
+    def enter_bulk_writes(self, db_aliases, tables):
+        if not self.bulk_depth:
+            self.bulk_written_tables = defaultdict(dict)
+            self.bulk_declared_dbs = set()
+            self.bulk_raw_writes = set()
+        self.bulk_depth += 1
+        if tables:
+            self.bulk_declared_dbs.update(db_aliases)
+            for db_alias in db_aliases:
+                for table in tables:
+                    self.add_bulk_write(db_alias, table)
+
+    def exit_bulk_writes(self):
+        """
+        Returns a dict of the tables written per database alias
+        when exiting the outermost bulk block, ``None`` meaning all tables.
+        """
+        self.bulk_depth -= 1
+        if self.bulk_depth:
+            return {}
+        written = {db_alias: set(tables.values())
+                   for db_alias, tables in self.bulk_written_tables.items()}
+        for db_alias in self.bulk_raw_writes:
+            if db_alias not in self.bulk_declared_dbs:
+                written[db_alias] = None
+        return written
+
+    def add_bulk_write(self, db_alias, table):
+        self.bulk_written_tables[db_alias].update(
+            _get_table_invalidation_keys(db_alias, (table,)))
+
+    def add_bulk_raw_write(self, db_alias):
+        self.bulk_raw_writes.add(db_alias)
+
+    def is_bulk_written(self, db_alias, table_cache_keys):
+        if db_alias in self.bulk_raw_writes \
+                and db_alias not in self.bulk_declared_dbs:
+            return True
+        written = self.bulk_written_tables.get(db_alias)
+        return bool(written) and not written.keys().isdisjoint(
+            table_cache_keys)
+
+    def enter_batch(self, fetched):
+        """
+        Starts using the data ``fetched`` for each query cache key,
+        and delays storing query results until ``exit_batch``.
+        """
+        self.batch_fetched = fetched
+        self.batch_pending = []
+
+    def exit_batch(self):
+        pending = self.batch_pending
+        self.batch_fetched = self.batch_pending = None
+        data_per_cache = {}
+        for cache, data, timeouts in pending:
+            cache_data, cache_timeouts = data_per_cache.setdefault(
+                id(cache), (cache, {}, {}))[1:]
+            cache_data.update(data)
+            cache_timeouts.update(timeouts)
+        for cache, data, timeouts in data_per_cache.values():
+            _set_many(cache, data, timeouts)
+
+    def enter_prefetch(self, table_cache_keys):
+        """
+        Starts remembering the table timestamps fetched while evaluating
+        a queryset with ``prefetch_related``, ``table_cache_keys`` being
+        fetched with the first cache lookup.
+        """
+        self.prefetch_timestamps = {}
+        self.prefetch_table_cache_keys = table_cache_keys
+
+    def exit_prefetch(self):
+        self.prefetch_timestamps = None
+        self.prefetch_table_cache_keys = ()
+
+    def enter_derived(self, cache_key, get_result):
+        """
+        Allows the next query to be answered by ``get_result`` applied
+        to the rows cached in ``cache_key``, when its own result
+        is not cached.
+        """
+        self.derived_from = (cache_key, get_result)
 
+    def exit_derived(self):
+        self.derived_from = None
 
 cachalot_caches = CacheHandler()
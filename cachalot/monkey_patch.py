@@ -1,20 +1,29 @@
 from collections.abc import Iterable
 from functools import wraps
+from random import choice, random, randrange
 from time import time
 
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.core.exceptions import EmptyResultSet
 from django.db.backends.utils import CursorWrapper
+from django.db.models import QuerySet
 from django.db.models.signals import post_migrate
 from django.db.models.sql.compiler import (
     SQLCompiler, SQLInsertCompiler, SQLUpdateCompiler, SQLDeleteCompiler,
 )
+from django.db.models.sql.constants import MULTI
+from django.db.models.sql.query import Query
 from django.db.transaction import Atomic, get_connection
 
-from .api import invalidate, LOCAL_STORAGE
-from .cache import cachalot_caches
+from .api import _invalidate_fragments, invalidate, LOCAL_STORAGE
+from .cache import cachalot_caches, get_frequency_sketch
 from .settings import cachalot_settings, ITERABLES
+from .transaction import MISSING
 from .utils import (
-    _get_table_cache_keys, _get_tables_from_sql,
+    _get_hash_tag_prefix, _get_prefetch_tables, _get_query_with_bucketed_now,
+    _get_shortest_timeout, _get_split_cache_keys, _get_split_lookup,
+    _get_table_cache_keys, _get_table_timeout, _get_tables_from_sql,
+    _get_timeouts, _get_written_fragments, _set_many,
     UncachableQuery, is_cachable, filter_cachable,
 )
 
@@ -32,59 +41,408 @@ def _unset_raw_connection(original):
     return inner
 
 
-def _get_result_or_execute_query(execute_query_func, cache,
-                                 cache_key, table_cache_keys):
-    data = cache.get_many(table_cache_keys + [cache_key])
+def _get_many_from(cache, table_cache, cache_keys, table_cache_keys):
+    if table_cache is cache:
+        return cache.get_many(list(table_cache_keys) + cache_keys)
+    data = table_cache.get_many(list(table_cache_keys))
+    data.update(cache.get_many(cache_keys))
+    return data
+
+
+def _get_many_during_prefetch(cache, table_cache, cache_keys,
+                              table_cache_keys):
+    """
+    Only fetches the table cache keys that were not already fetched
+    while evaluating the current ``prefetch_related`` chain.
+    """
+    timestamps = cachalot_caches.prefetch_timestamps.setdefault(
+        id(table_cache), {})
+    keys = set(table_cache_keys)
+    keys.update(cachalot_caches.prefetch_table_cache_keys)
+    keys.difference_update(timestamps)
+    cachalot_caches.prefetch_table_cache_keys = ()
+    data = _get_many_from(cache, table_cache, cache_keys, keys)
+    for k in keys:
+        timestamps[k] = data.pop(k, None)
+    data.update((k, timestamps[k]) for k in table_cache_keys
+                if timestamps[k] is not None)
+    return data
+
+
+def _get_many(cache, table_cache, cache_keys, table_cache_keys):
+    if cachalot_caches.prefetch_timestamps is None:
+        return _get_many_from(cache, table_cache, cache_keys,
+                              table_cache_keys)
+    return _get_many_during_prefetch(cache, table_cache, cache_keys,
+                                     table_cache_keys)
+
+
+def _set_results(cache, table_cache, results, table_cache_keys,
+                 new_table_cache_keys, options, timestamp=None):
+    """
+    Caches ``results``, a dict of query cache keys mapped to their result,
+    along with the table cache keys that were missing.  ``timestamp``
+    is when the results were fetched from the database, by default now.
+    """
+    now = time()
+    if timestamp is None:
+        timestamp = now
+    data_per_cache = {id(cache): (cache, {})}
+    data_per_cache.setdefault(id(table_cache), (table_cache, {}))[1].update(
+        (k, now) for k in new_table_cache_keys)
+    data_per_cache[id(cache)][1].update(
+        (k, (timestamp, result)) for k, result in results.items())
+    timeout = options.get('timeout', DEFAULT_TIMEOUT)
+    timeouts = _get_timeouts(
+        {k: table_cache_keys[k] for k in new_table_cache_keys})
+    if timeout is DEFAULT_TIMEOUT \
+            and cachalot_settings.CACHALOT_TABLE_TIMEOUTS:
+        # The result is useless once a table cache key expired.
+        timeout = _get_shortest_timeout(
+            _get_table_timeout(t) for t in set(table_cache_keys.values()))
+    if timeout is not DEFAULT_TIMEOUT:
+        timeouts.update(dict.fromkeys(results, timeout))
+    if cachalot_caches.prefetch_timestamps is not None:
+        cachalot_caches.prefetch_timestamps.setdefault(
+            id(table_cache), {}).update((k, now) for k in new_table_cache_keys)
+    for cache, to_be_set in data_per_cache.values():
+        if not to_be_set:
+            continue
+        if cachalot_caches.batch_pending is not None:
+            cachalot_caches.batch_pending.append((cache, to_be_set, timeouts))
+        else:
+            _set_many(cache, to_be_set, timeouts)
+
+
+def _is_fresh(timestamp, max_timestamp, options):
+    if timestamp >= max_timestamp:
+        return True
+    stale = options.get('stale')
+    return stale is not None and time() - timestamp <= stale
+
+
+def _get_max_timestamp(data, table_cache_keys, new_table_cache_keys,
+                       options):
+    """
+    Returns the last invalidation of the tables of a query, or ``None``
+    if its results fetched in ``data`` cannot be used.
+    """
+    if not new_table_cache_keys and not options.get('refresh'):
+        try:
+            return max(data[k] for k in table_cache_keys)
+        except (TypeError, ValueError):
+            pass
+
+
+def _get_fresh_result(data, cache_key, max_timestamp, options):
+    """
+    Returns the result cached in ``cache_key`` if it is still valid,
+    otherwise returns ``MISSING``.
+    """
+    if max_timestamp is None:
+        return MISSING
+    try:
+        timestamp, result = data[cache_key]
+        if _is_fresh(timestamp, max_timestamp, options):
+            return result
+    except (KeyError, TypeError, ValueError):
+        # In case `cache_key` is not in `data` or contains bad data,
+        # we simply run the query and cache again the results.
+        pass
+    return MISSING
+
+
+def _get_derived_result(data, cache_key, get_result, max_timestamp,
+                        options):
+    """
+    Returns ``get_result`` applied to the number of rows cached
+    in ``cache_key``, otherwise returns ``MISSING``.
+    """
+    rows = _get_fresh_result(data, cache_key, max_timestamp, options)
+    # Unlike other results, `execute_sql(MULTI)` gives a list of chunks.
+    if rows.__class__ is not list \
+            or any(chunk.__class__ not in (list, tuple) for chunk in rows):
+        return MISSING
+    n_rows = sum(len(chunk) for chunk in rows)
+    if n_rows > cachalot_settings.CACHALOT_DERIVE_MAX_ROWS:
+        return MISSING
+    return get_result(n_rows)
+
+
+def _get_replica_cache_keys(cache_key):
+    """
+    Returns the cache keys of the copies of ``cache_key`` if it is one
+    of the ``CACHALOT_HOT_KEYS`` most read query cache keys,
+    otherwise returns an empty list.
+    """
+    sketch = get_frequency_sketch(cachalot_settings.CACHALOT_HOT_KEYS)
+    if random() < cachalot_settings.CACHALOT_HOT_KEY_SAMPLE_RATE:
+        sketch.add(cache_key)
+    if not sketch.is_hot(cache_key):
+        return []
+    return ['%s:r%d' % (cache_key, i)
+            for i in range(cachalot_settings.CACHALOT_HOT_KEY_REPLICAS)]
+
+
+def _get_result_or_execute_query(execute_query_func, cache, table_cache,
+                                 cache_key, table_cache_keys, options):
+    derived_from = cachalot_caches.derived_from
+    cachalot_caches.derived_from = None
+    replica_cache_keys = []
+    if cachalot_settings.CACHALOT_HOT_KEYS is not None:
+        replica_cache_keys = _get_replica_cache_keys(cache_key)
+    read_cache_key = cache_key
+    data = None
+    if cachalot_caches.batch_fetched is not None:
+        # Already fetched by `fetch_many`.
+        data = cachalot_caches.batch_fetched.pop(cache_key, None)
+    if data is None:
+        cache_keys = [cache_key]
+        if replica_cache_keys:
+            # Spreads the reads of a hot query over its copies.
+            read_cache_key = choice(replica_cache_keys)
+            cache_keys.append(read_cache_key)
+        if derived_from is not None:
+            cache_keys.append(derived_from[0])
+        data = _get_many(cache, table_cache, cache_keys, table_cache_keys)
 
     new_table_cache_keys = set(table_cache_keys)
     new_table_cache_keys.difference_update(data)
-
-    if not new_table_cache_keys:
-        try:
-            timestamp, result = data.pop(cache_key)
-            if timestamp >= max(data.values()):
-                return result
-        except (KeyError, TypeError, ValueError):
-            # In case `cache_key` is not in `data` or contains bad data,
-            # we simply run the query and cache again the results.
-            pass
+    max_timestamp = _get_max_timestamp(data, table_cache_keys,
+                                       new_table_cache_keys, options)
+
+    result = _get_fresh_result(data, read_cache_key, max_timestamp, options)
+    if result is not MISSING:
+        return result
+    if read_cache_key != cache_key:
+        # Hot keys are detected per process, so other processes
+        # may only have cached the result again in `cache_key`.
+        result = _get_fresh_result(data, cache_key, max_timestamp, options)
+        if result is not MISSING:
+            _set_results(cache, table_cache,
+                         dict.fromkeys(replica_cache_keys, result),
+                         table_cache_keys, (), options,
+                         timestamp=data[cache_key][0])
+            return result
+    if derived_from is not None:
+        result = _get_derived_result(data, *derived_from,
+                                     max_timestamp, options)
+        if result is not MISSING:
+            return result
 
     result = execute_query_func()
     if result.__class__ not in ITERABLES and isinstance(result, Iterable):
         result = list(result)
 
-    now = time()
-    to_be_set = {k: now for k in new_table_cache_keys}
-    to_be_set[cache_key] = (now, result)
-    cache.set_many(to_be_set, cachalot_settings.CACHALOT_TIMEOUT)
+    results = dict.fromkeys(replica_cache_keys, result)
+    results[cache_key] = result
+    _set_results(cache, table_cache, results, table_cache_keys,
+                 new_table_cache_keys, options)
 
     return result
 
 
+def _get_sliced_result_or_execute_query(original, compiler, args, kwargs,
+                                        cache, table_cache, cache_key,
+                                        table_cache_keys, options):
+    """
+    Slices the cached result of the same query without LIMIT and OFFSET
+    or of the window of ``CACHALOT_SLICE_WINDOW`` rows enclosing the slice,
+    otherwise queries this window instead of the slice.
+    """
+    query = compiler.query
+    low_mark, high_mark = query.low_mark, query.high_mark
+    get_query_cache_key = cachalot_settings.CACHALOT_QUERY_KEYGEN
+    full_query = query.clone()
+    full_query.clear_limits()
+    full_cache_key = get_query_cache_key(
+        full_query.get_compiler(compiler.using))
+    cache_keys = [cache_key, full_cache_key]
+    window = cachalot_settings.CACHALOT_SLICE_WINDOW
+    window_low_mark = low_mark - low_mark % window
+    window_compiler = window_cache_key = None
+    if high_mark is not None and high_mark <= window_low_mark + window:
+        window_query = full_query.clone()
+        window_query.set_limits(window_low_mark, window_low_mark + window)
+        window_compiler = window_query.get_compiler(compiler.using)
+        window_cache_key = get_query_cache_key(window_compiler)
+        cache_keys.append(window_cache_key)
+    data = _get_many(cache, table_cache, cache_keys, table_cache_keys)
+
+    new_table_cache_keys = set(table_cache_keys)
+    new_table_cache_keys.difference_update(data)
+    max_timestamp = _get_max_timestamp(data, table_cache_keys,
+                                       new_table_cache_keys, options)
+
+    result = _get_fresh_result(data, cache_key, max_timestamp, options)
+    if result is not MISSING:
+        return result
+    result = _get_fresh_result(data, full_cache_key, max_timestamp, options)
+    offset = 0
+    if result is MISSING and window_compiler is not None:
+        offset = window_low_mark
+        result = _get_fresh_result(data, window_cache_key, max_timestamp,
+                                   options)
+        if result is MISSING:
+            result = list(original(window_compiler, *args, **kwargs))
+            _set_results(cache, table_cache, {window_cache_key: result},
+                         table_cache_keys, new_table_cache_keys, options)
+    if result is MISSING:
+        result = list(original(compiler, *args, **kwargs))
+        _set_results(cache, table_cache, {cache_key: result},
+                     table_cache_keys, new_table_cache_keys, options)
+        return result
+
+    rows = [row for chunk in result for row in chunk]
+    if high_mark is None:
+        return [rows[low_mark - offset:]]
+    return [rows[low_mark - offset:high_mark - offset]]
+
+
+def _get_split_result_or_execute_query(original, compiler, args, kwargs,
+                                       cache, table_cache, cache_key,
+                                       table_cache_keys, split, options):
+    """
+    Gets the rows of each value of the ``__in`` lookup found
+    by ``_get_split_lookup`` from the cache, only queries the rows
+    of the missing values and merges them.
+    """
+    position, index = split
+    # The rows of each value are stored in the same slot as the query.
+    value_cache_keys = _get_split_cache_keys(
+        compiler, position, _get_hash_tag_prefix(cache_key))
+    data = _get_many(cache, table_cache, list(value_cache_keys.values()),
+                     table_cache_keys)
+
+    new_table_cache_keys = set(table_cache_keys)
+    new_table_cache_keys.difference_update(data)
+    max_timestamp = _get_max_timestamp(data, table_cache_keys,
+                                       new_table_cache_keys, options)
+
+    rows = []
+    missing_values = []
+    for value, key in value_cache_keys.items():
+        value_rows = _get_fresh_result(data, key, max_timestamp, options)
+        if value_rows is MISSING:
+            missing_values.append(value)
+        else:
+            rows.extend(value_rows)
+
+    if missing_values:
+        query = compiler.query.clone()
+        lookup = query.where.children[position]
+        query.where.children[position] = lookup.__class__(
+            lookup.lhs, missing_values)
+        result = original(query.get_compiler(compiler.using), *args, **kwargs)
+        rows_per_value = {v: [] for v in missing_values}
+        cachable = True
+        for chunk in result:
+            for row in chunk:
+                rows.append(row)
+                value_rows = rows_per_value.get(row[index])
+                if value_rows is None:
+                    # The database converted the values, for example
+                    # with a case-insensitive collation.
+                    cachable = False
+                else:
+                    value_rows.append(row)
+        if cachable:
+            _set_results(
+                cache, table_cache,
+                {value_cache_keys[v]: value_rows
+                 for v, value_rows in rows_per_value.items()},
+                table_cache_keys, new_table_cache_keys, options)
+
+    return [rows]
+
+
+def _get_query_cache_keys(compiler):
+    """
+    Returns the cache key and the table cache keys of the query
+    of ``compiler``, or ``None`` if it must not use the cache.
+    """
+    # Checks if utils/cachalot_disabled
+    if not getattr(LOCAL_STORAGE, "cachalot_enabled", True):
+        return
+
+    db_alias = compiler.using
+    options = getattr(compiler.query, 'cachalot_options', {})
+    if db_alias not in cachalot_settings.CACHALOT_DATABASES \
+            or isinstance(compiler, WRITE_COMPILERS) \
+            or not options.get('enabled', True):
+        return
+
+    bucketed_query = None
+    key_compiler = compiler
+    if cachalot_settings.CACHALOT_NOW_BUCKET is not None:
+        bucketed_query = _get_query_with_bucketed_now(compiler.query)
+        if bucketed_query is not None:
+            key_compiler = bucketed_query.get_compiler(db_alias)
+
+    try:
+        cache_key = cachalot_settings.CACHALOT_QUERY_KEYGEN(key_compiler)
+        table_cache_keys = _get_table_cache_keys(key_compiler)
+    except (EmptyResultSet, UncachableQuery):
+        return
+
+    pool_size = cachalot_settings.CACHALOT_RANDOM_POOL_SIZE
+    if pool_size is not None and '?' in key_compiler.query.order_by:
+        # Each execution of a random query uses one of several results.
+        cache_key = '%s:%d' % (cache_key, randrange(pool_size))
+
+    if cachalot_caches.bulk_depth and cachalot_caches.is_bulk_written(
+            db_alias, table_cache_keys):
+        return
+
+    if cachalot_caches.deferral_depth:
+        cachalot_caches.flush_deferred_invalidations(
+            cachalot_caches.get_table_cache_alias(), db_alias,
+            table_cache_keys)
+
+    if bucketed_query is not None:
+        # Only cached queries use the bucketed time, so the compiler
+        # is set up again with the query its result is cached for.
+        compiler.query = bucketed_query
+        compiler.setup_query()
+
+    return cache_key, table_cache_keys
+
+
 def _patch_compiler(original):
     @wraps(original)
     @_unset_raw_connection
     def inner(compiler, *args, **kwargs):
         execute_query_func = lambda: original(compiler, *args, **kwargs)
-        # Checks if utils/cachalot_disabled
-        if not getattr(LOCAL_STORAGE, "cachalot_enabled", True):
+        keys = _get_query_cache_keys(compiler)
+        if keys is None:
             return execute_query_func()
 
-        db_alias = compiler.using
-        if db_alias not in cachalot_settings.CACHALOT_DATABASES \
-                or isinstance(compiler, WRITE_COMPILERS):
-            return execute_query_func()
-
-        try:
-            cache_key = cachalot_settings.CACHALOT_QUERY_KEYGEN(compiler)
-            table_cache_keys = _get_table_cache_keys(compiler)
-        except (EmptyResultSet, UncachableQuery):
-            return execute_query_func()
+        cache_key, table_cache_keys = keys
+        cache = cachalot_caches.get_cache(
+            db_alias=compiler.using, tables=table_cache_keys.values())
+        table_cache = cachalot_caches.get_table_cache(db_alias=compiler.using)
+        options = getattr(compiler.query, 'cachalot_options', {})
+        if cachalot_caches.batch_fetched is None \
+                and (args[0] if args else kwargs.get('result_type')) \
+                in (MULTI, None):
+            query = compiler.query
+            # `Query.is_sliced` does not exist before Django 3.0.
+            if cachalot_settings.CACHALOT_SLICE_WINDOW is not None \
+                    and (query.low_mark or query.high_mark is not None) \
+                    and '?' not in query.order_by:
+                return _get_sliced_result_or_execute_query(
+                    original, compiler, args, kwargs, cache, table_cache,
+                    cache_key, table_cache_keys, options)
+            if cachalot_settings.CACHALOT_SPLIT_IN_QUERIES:
+                split = _get_split_lookup(compiler)
+                if split is not None:
+                    return _get_split_result_or_execute_query(
+                        original, compiler, args, kwargs, cache, table_cache,
+                        cache_key, table_cache_keys, split, options)
 
         return _get_result_or_execute_query(
-            execute_query_func,
-            cachalot_caches.get_cache(db_alias=db_alias),
-            cache_key, table_cache_keys)
+            execute_query_func, cache, table_cache, cache_key,
+            table_cache_keys, options)
 
     return inner
 
@@ -96,16 +454,76 @@ def _patch_write_compiler(original):
         db_alias = write_compiler.using
         table = write_compiler.query.get_meta().db_table
         if is_cachable(table):
-            invalidate(table, db_alias=db_alias,
-                       cache_alias=cachalot_settings.CACHALOT_CACHE)
+            if cachalot_caches.bulk_depth:
+                cachalot_caches.add_bulk_write(db_alias, table)
+            else:
+                fragments = _get_written_fragments(write_compiler.query)
+                if fragments is None:
+                    invalidate(table, db_alias=db_alias,
+                               cache_alias=cachalot_settings.CACHALOT_CACHE)
+                else:
+                    _invalidate_fragments(
+                        table, fragments, db_alias=db_alias,
+                        cache_alias=cachalot_settings.CACHALOT_CACHE)
         return original(write_compiler, *args, **kwargs)
 
     return inner
 
 
+def _patch_prefetch(original):
+    @wraps(original)
+    def inner(queryset):
+        if queryset._result_cache is not None \
+                or not queryset._prefetch_related_lookups \
+                or cachalot_caches.prefetch_timestamps is not None:
+            return original(queryset)
+
+        db_alias = queryset.db
+        get_table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN
+        tables = filter_cachable(_get_prefetch_tables(
+            queryset.model, queryset._prefetch_related_lookups))
+        table_cache_keys = [get_table_cache_key(db_alias, t) for t in tables]
+        if cachalot_caches.deferral_depth:
+            # Like in `_get_query_cache_keys`, since these timestamps
+            # are fetched by the first lookup.
+            cachalot_caches.flush_deferred_invalidations(
+                cachalot_caches.get_table_cache_alias(), db_alias,
+                table_cache_keys)
+        cachalot_caches.enter_prefetch(table_cache_keys)
+        try:
+            return original(queryset)
+        finally:
+            cachalot_caches.exit_prefetch()
+
+    return inner
+
+
+def _patch_derived(original, get_result):
+    @wraps(original)
+    def inner(query, using):
+        if cachalot_settings.CACHALOT_DERIVE_MAX_ROWS is None:
+            return original(query, using)
+        keys = _get_query_cache_keys(query.get_compiler(using))
+        if keys is None:
+            return original(query, using)
+        cachalot_caches.enter_derived(keys[0], get_result)
+        try:
+            return original(query, using)
+        finally:
+            cachalot_caches.exit_derived()
+
+    return inner
+
+
 def _patch_orm():
     if cachalot_settings.CACHALOT_ENABLED:
         SQLCompiler.execute_sql = _patch_compiler(SQLCompiler.execute_sql)
+        QuerySet._fetch_all = _patch_prefetch(QuerySet._fetch_all)
+        # `count()` and `exists()` may be answered from cached rows.
+        Query.get_count = _patch_derived(
+            Query.get_count, lambda n_rows: (n_rows,))
+        Query.has_results = _patch_derived(
+            Query.has_results, lambda n_rows: (1,) if n_rows else None)
     for compiler in WRITE_COMPILERS:
         compiler.execute_sql = _patch_write_compiler(compiler.execute_sql)
 
@@ -113,10 +531,24 @@ def _patch_orm():
 def _unpatch_orm():
     if hasattr(SQLCompiler.execute_sql, '__wrapped__'):
         SQLCompiler.execute_sql = SQLCompiler.execute_sql.__wrapped__
+        QuerySet._fetch_all = QuerySet._fetch_all.__wrapped__
+        Query.get_count = Query.get_count.__wrapped__
+        Query.has_results = Query.has_results.__wrapped__
     for compiler in WRITE_COMPILERS:
         compiler.execute_sql = compiler.execute_sql.__wrapped__
 
 
+def _invalidate_raw_write(connection, sql):
+    if cachalot_caches.bulk_depth:
+        # Table detection is skipped in bulk blocks.
+        cachalot_caches.add_bulk_raw_write(connection.alias)
+        return
+    tables = filter_cachable(_get_tables_from_sql(connection, sql))
+    if tables:
+        invalidate(*tables, db_alias=connection.alias,
+                   cache_alias=cachalot_settings.CACHALOT_CACHE)
+
+
 def _patch_cursor():
     def _patch_cursor_execute(original):
         @wraps(original)
@@ -132,12 +564,7 @@ def _patch_cursor():
                     if 'update' in sql or 'insert' in sql or 'delete' in sql \
                             or 'alter' in sql or 'create' in sql \
                             or 'drop' in sql:
-                        tables = filter_cachable(
-                            _get_tables_from_sql(connection, sql))
-                        if tables:
-                            invalidate(
-                                *tables, db_alias=connection.alias,
-                                cache_alias=cachalot_settings.CACHALOT_CACHE)
+                        _invalidate_raw_write(connection, sql)
 
         return inner
 
@@ -166,11 +593,16 @@ def _patch_atomic():
         @wraps(original)
         def inner(self, exc_type, exc_value, traceback):
             needs_rollback = get_connection(self.using).needs_rollback
+            commit = exc_type is None and not needs_rollback
+            executor = cachalot_settings.CACHALOT_COMMIT_EXECUTOR
+            if commit and executor is not None \
+                    and cachalot_caches.is_outermost_atomic(self.using):
+                cachalot_caches.exit_atomic_on_commit(self.using, executor)
+                return original(self, exc_type, exc_value, traceback)
             try:
                 original(self, exc_type, exc_value, traceback)
             finally:
-                cachalot_caches.exit_atomic(
-                    self.using, exc_type is None and not needs_rollback)
+                cachalot_caches.exit_atomic(self.using, commit)
 
         return inner
 
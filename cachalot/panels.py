@@ -43,7 +43,7 @@ class CachalotPanel(Panel):
     def collect_invalidations(self):
         models = apps.get_models()
         data = defaultdict(list)
-        cache = cachalot_caches.get_cache()
+        cache = cachalot_caches.get_table_cache()
         for db_alias in settings.DATABASES:
             get_table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN
             model_cache_keys = {
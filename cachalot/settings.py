@@ -46,14 +46,33 @@ class Settings(object):
 
     CACHALOT_ENABLED = True
     CACHALOT_CACHE = 'default'
+    CACHALOT_TABLE_CACHE = None
+    CACHALOT_RESULT_CACHES = {}
+    CACHALOT_CACHE_SHARDS = ()
+    CACHALOT_CACHE_SHARD_WORKERS = None
     CACHALOT_DATABASES = 'supported_only'
     CACHALOT_TIMEOUT = None
+    CACHALOT_TABLE_TIMEOUTS = {}
     CACHALOT_CACHE_RANDOM = False
+    CACHALOT_RANDOM_POOL_SIZE = None
     CACHALOT_INVALIDATE_RAW = True
     CACHALOT_ONLY_CACHABLE_TABLES = ()
     CACHALOT_UNCACHABLE_TABLES = ('django_migrations',)
+    CACHALOT_ROW_LEVEL_TABLES = ()
+    CACHALOT_PARTITION_COLUMNS = {}
+    CACHALOT_COLUMN_LEVEL_TABLES = ()
+    CACHALOT_SPLIT_IN_QUERIES = False
+    CACHALOT_SLICE_WINDOW = None
+    CACHALOT_DERIVE_MAX_ROWS = None
+    CACHALOT_NOW_BUCKET = None
+    CACHALOT_HOT_KEYS = None
+    CACHALOT_HOT_KEY_REPLICAS = 4
+    CACHALOT_HOT_KEY_SAMPLE_RATE = 0.01
     CACHALOT_QUERY_KEYGEN = 'cachalot.utils.get_query_cache_key'
     CACHALOT_TABLE_KEYGEN = 'cachalot.utils.get_table_cache_key'
+    CACHALOT_HASH_TAG_GROUPS = {}
+    CACHALOT_COMMIT_EXECUTOR = None
+    CACHALOT_ATOMIC_MAX_ENTRIES = None
 
     @classmethod
     def add_converter(cls, setting):
@@ -91,6 +110,21 @@ class Settings(object):
         self.load()
 
 
+@Settings.add_converter('CACHALOT_RESULT_CACHES')
+def convert(value):
+    # We import this here to avoid a circular import issue.
+    from .api import _get_tables
+
+    return {table: cache_alias
+            for table_or_model, cache_alias in dict(value).items()
+            for table in _get_tables((table_or_model,))}
+
+
+@Settings.add_converter('CACHALOT_CACHE_SHARDS')
+def convert(value):
+    return tuple(value)
+
+
 @Settings.add_converter('CACHALOT_DATABASES')
 def convert(value):
     if value == SUPPORTED_ONLY:
@@ -111,6 +145,26 @@ def convert(value):
     return frozenset(value)
 
 
+@Settings.add_converter('CACHALOT_TABLE_TIMEOUTS')
+def convert(value):
+    return dict(value)
+
+
+@Settings.add_converter('CACHALOT_ROW_LEVEL_TABLES')
+def convert(value):
+    return frozenset(value)
+
+
+@Settings.add_converter('CACHALOT_PARTITION_COLUMNS')
+def convert(value):
+    return dict(value)
+
+
+@Settings.add_converter('CACHALOT_COLUMN_LEVEL_TABLES')
+def convert(value):
+    return frozenset(value)
+
+
 @Settings.add_converter('CACHALOT_QUERY_KEYGEN')
 def convert(value):
     return import_string(value)
@@ -121,4 +175,20 @@ def convert(value):
     return import_string(value)
 
 
+@Settings.add_converter('CACHALOT_HASH_TAG_GROUPS')
+def convert(value):
+    # We import this here to avoid a circular import issue.
+    from .api import _get_tables
+
+    return {table: group
+            for table_or_model, group in dict(value).items()
+            for table in _get_tables((table_or_model,))}
+
+
+@Settings.add_converter('CACHALOT_COMMIT_EXECUTOR')
+def convert(value):
+    if value is not None:
+        return import_string(value)
+
+
 cachalot_settings = Settings()
@@ -1,5 +1,5 @@
 from time import time, sleep
-from unittest import skipIf
+from unittest import mock, skipIf
 
 from django.conf import settings
 from django.contrib.auth.models import Permission, User
@@ -11,6 +11,9 @@ from django.test import TransactionTestCase
 from jinja2.exceptions import TemplateSyntaxError
 
 from ..api import *
+from ..signals import post_invalidation
+from ..utils import (
+    CACHABLE_PARAM_TYPES, PARAM_ENCODERS, get_query_cache_key)
 from .models import Test
 from .test_utils import TestUtilsMixin
 
@@ -306,6 +309,223 @@ class APITestCase(TestUtilsMixin, TransactionTestCase):
         with cachalot_disabled() and self.assertNumQueries(1):
             list(qs.all())
 
+    def test_deferred_invalidations(self):
+        cache = caches[DEFAULT_CACHE_ALIAS]
+        with self.assertNumQueries(1):
+            data1 = list(Test.objects.all())
+        self.assertListEqual(data1, [self.t1])
+
+        with mock.patch.object(cache, 'set_many',
+                               wraps=cache.set_many) as set_many:
+            with cachalot_deferred_invalidations():
+                t2 = Test.objects.create(name='test2')
+                t3 = Test.objects.create(name='test3')
+                with cachalot_deferred_invalidations():
+                    t4 = Test.objects.create(name='test4')
+                self.assertEqual(set_many.call_count, 0)
+            self.assertEqual(set_many.call_count, 1)
+
+        with self.assertNumQueries(1):
+            data2 = list(Test.objects.all())
+        self.assertListEqual(data2, [self.t1, t2, t3, t4])
+
+    def test_deferred_invalidations_read_dirty_table(self):
+        with self.assertNumQueries(2):
+            list(Test.objects.all())
+            list(User.objects.all())
+
+        with cachalot_deferred_invalidations():
+            t2 = Test.objects.create(name='test2')
+            with self.assertNumQueries(0):
+                list(User.objects.all())
+            with self.assertNumQueries(1):
+                data = list(Test.objects.all())
+            self.assertListEqual(data, [self.t1, t2])
+            with self.assertNumQueries(0):
+                list(Test.objects.all())
+
+            self.assertAlmostEqual(get_last_invalidation(Test), time(),
+                                   delta=0.1)
+
+    def test_deferred_invalidations_read_dirty_prefetched_table(self):
+        self.t1.owner = self.user
+        self.t1.save()
+        qs = Test.objects.prefetch_related('owner')
+        self.assertListEqual([t.owner.username for t in qs.all()], ['user'])
+
+        with cachalot_deferred_invalidations():
+            User.objects.filter(pk=self.user.pk).update(username='new')
+            self.assertListEqual(
+                [t.owner.username for t in qs.all()], ['new'])
+            self.assertListEqual(
+                list(User.objects.values_list('username', flat=True)),
+                ['new'])
+
+    def test_deferred_invalidations_signal(self):
+        tables = []
+
+        def receiver(sender, **kwargs):
+            tables.append(sender)
+
+        post_invalidation.connect(receiver)
+        try:
+            with cachalot_deferred_invalidations():
+                Test.objects.create(name='test2')
+                self.assertListEqual(tables, [])
+        finally:
+            post_invalidation.disconnect(receiver)
+        self.assertListEqual(tables, [Test._meta.db_table])
+
+    def test_bulk_writes(self):
+        cache = caches[DEFAULT_CACHE_ALIAS]
+        with self.assertNumQueries(2):
+            list(Test.objects.all())
+            list(User.objects.all())
+
+        with mock.patch.object(cache, 'set_many',
+                               wraps=cache.set_many) as set_many:
+            with cachalot_bulk_writes():
+                t2 = Test.objects.create(name='test2')
+                Test.objects.filter(pk=t2.pk).update(name='test3')
+                with self.assertNumQueries(1):
+                    data1 = list(Test.objects.all())
+                self.assertEqual(data1[1].name, 'test3')
+                with self.assertNumQueries(1):
+                    list(Test.objects.all())
+                with self.assertNumQueries(0):
+                    list(User.objects.all())
+            self.assertEqual(set_many.call_count, 1)
+
+        with self.assertNumQueries(1):
+            data2 = list(Test.objects.all())
+        self.assertListEqual(data2, data1)
+        with self.assertNumQueries(0):
+            list(User.objects.all())
+
+    def test_bulk_writes_raw(self):
+        with self.assertNumQueries(2):
+            list(Test.objects.all())
+            list(User.objects.all())
+
+        with cachalot_bulk_writes():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO cachalot_test (name, public) "
+                    "VALUES ('test2', %s);", [1 if self.is_sqlite else True])
+            with self.assertNumQueries(1):
+                list(User.objects.all())
+
+        with self.assertNumQueries(2):
+            data = list(Test.objects.values_list('name', flat=True))
+            list(User.objects.all())
+        self.assertListEqual(data, ['test1', 'test2'])
+
+    def test_bulk_writes_declared_tables(self):
+        with self.assertNumQueries(2):
+            list(Test.objects.all())
+            list(User.objects.all())
+
+        with cachalot_bulk_writes(Test):
+            with self.assertNumQueries(1):
+                list(Test.objects.all())
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO cachalot_test (name, public) "
+                    "VALUES ('test2', %s);", [1 if self.is_sqlite else True])
+
+        with self.assertNumQueries(1):
+            data = list(Test.objects.values_list('name', flat=True))
+        self.assertListEqual(data, ['test1', 'test2'])
+        with self.assertNumQueries(0):
+            list(User.objects.all())
+
+    def test_queryset_timeout(self):
+        qs = CachalotQuerySet(Test)
+        self.assert_query_cached(qs.cachalot(timeout=0), after=1)
+        self.assert_query_cached(qs.filter(public=False))
+        with self.settings(CACHALOT_TABLE_TIMEOUTS={'cachalot_test': None}):
+            self.assert_query_cached(qs.filter(name='test1').cachalot(
+                timeout=0), [self.t1], after=1)
+            self.assert_query_cached(qs.filter(name='test1'), [self.t1])
+
+    def test_queryset_nocache(self):
+        qs = CachalotQuerySet(Test)
+        self.assert_query_cached(qs.nocache(), [self.t1], after=1)
+        self.assert_query_cached(qs.nocache().cachalot(enabled=True),
+                                 [self.t1])
+        # Other options are kept.
+        self.assert_query_cached(qs.cachalot(timeout=0).nocache().cachalot(
+            enabled=True).filter(name='test1'), [self.t1], after=1)
+
+    def test_queryset_refresh(self):
+        qs = CachalotQuerySet(Test)
+        self.assert_query_cached(qs, [self.t1])
+        with self.settings(CACHALOT_INVALIDATE_RAW=False):
+            with connection.cursor() as cursor:
+                cursor.execute("UPDATE cachalot_test SET name = 'new name';")
+        self.assert_query_cached(qs, [self.t1], before=0)
+        self.assert_query_cached(qs.cachalot(refresh=True), after=1)
+        self.assertEqual(qs.get().name, 'new name')
+
+    def test_queryset_stale(self):
+        qs = CachalotQuerySet(Test)
+        self.assert_query_cached(qs, [self.t1])
+        t2 = Test.objects.create(name='test2')
+        self.assert_query_cached(qs.cachalot(stale=60), [self.t1], before=0)
+        sleep(0.05)
+        self.assert_query_cached(qs.cachalot(stale=0.01), [self.t1, t2])
+
+    def test_register_param_type(self):
+        class Name(str):
+            pass
+
+        qs = Test.objects.filter(name=Name('test1'))
+        self.assert_query_cached(qs, [self.t1], after=1)
+        try:
+            register_param_type(Name, lambda name: 'name:%s' % name)
+            self.assert_query_cached(qs, [self.t1])
+            self.assertEqual(PARAM_ENCODERS[Name](Name('test1')),
+                             'name:test1')
+            self.assertNotEqual(
+                get_query_cache_key(qs.query.get_compiler(DEFAULT_DB_ALIAS)),
+                get_query_cache_key(Test.objects.filter(name='test1')
+                                    .query.get_compiler(DEFAULT_DB_ALIAS)))
+
+            register_param_type(Name)
+            self.assertNotIn(Name, PARAM_ENCODERS)
+            self.assert_query_cached(Test.objects.filter(
+                name__in=[Name('test1'), Name('test2')]), [self.t1])
+        finally:
+            CACHABLE_PARAM_TYPES.discard(Name)
+            PARAM_ENCODERS.pop(Name, None)
+
+    def test_fetch_many(self):
+        cache = caches[DEFAULT_CACHE_ALIAS]
+        with mock.patch.object(cache, 'get_many',
+                               wraps=cache.get_many) as get_many, \
+                mock.patch.object(cache, 'set_many',
+                                  wraps=cache.set_many) as set_many:
+            with self.assertNumQueries(2):
+                data = fetch_many(Test.objects.all(),
+                                  User.objects.filter(pk=self.user.pk),
+                                  Test.objects.none())
+            self.assertListEqual(data, [[self.t1], [self.user], []])
+            self.assertEqual(get_many.call_count, 1)
+            self.assertEqual(set_many.call_count, 1)
+
+            with self.assertNumQueries(0):
+                data = fetch_many(Test.objects.all(),
+                                  User.objects.filter(pk=self.user.pk))
+            self.assertListEqual(data, [[self.t1], [self.user]])
+            self.assertEqual(get_many.call_count, 2)
+            self.assertEqual(set_many.call_count, 1)
+
+        t2 = Test.objects.create(name='test2')
+        with self.assertNumQueries(1):
+            data = fetch_many(Test.objects.all(),
+                              User.objects.filter(pk=self.user.pk))
+        self.assertListEqual(data, [[self.t1, t2], [self.user]])
+
 
 class CommandTestCase(TransactionTestCase):
     multi_db = True
@@ -1,5 +1,5 @@
 import datetime
-from unittest import skipIf
+from unittest import mock, skipIf
 from uuid import UUID
 from decimal import Decimal
 
@@ -15,6 +15,7 @@ from django.db.models.functions import Now
 from django.db.transaction import TransactionManagementError
 from django.test import (
     TransactionTestCase, skipUnlessDBFeature, override_settings)
+from django.test.utils import CaptureQueriesContext
 from pytz import UTC
 
 from cachalot.cache import cachalot_caches
@@ -490,6 +491,26 @@ class ReadTestCase(TestUtilsMixin, TransactionTestCase):
         self.assertListEqual(permissions8, permissions7)
         self.assertListEqual(permissions8, self.group__permissions)
 
+    def test_prefetch_related_cache_lookups(self):
+        qs = Test.objects.prefetch_related('owner__groups__permissions')
+        cache = cachalot_caches.get_cache()
+        with mock.patch.object(cache, 'get_many',
+                               wraps=cache.get_many) as get_many:
+            with self.assertNumQueries(4):
+                data1 = list(qs.all())
+            # The tables of the prefetched models are fetched with the first
+            # lookup, then the next lookups only need their query results,
+            # except the content types joined to order permissions.
+            self.assertListEqual(
+                [len(args[0]) for args, kwargs in get_many.call_args_list],
+                [7, 1, 1, 2])
+            with self.assertNumQueries(0):
+                data2 = list(qs.all())
+        self.assertListEqual(data2, data1)
+        self.assertListEqual(
+            [p for t in data2 for g in t.owner.groups.all()
+             for p in g.permissions.all()], self.group__permissions)
+
     @skipIf(django_version < (2, 0),
             '`FilteredRelation` was introduced in Django 2.0.')
     def test_filtered_relation(self):
@@ -1043,3 +1064,42 @@ class ParameterTypeTestCase(TestUtilsMixin, TransactionTestCase):
             obj2 = qs.get()
         self.assertEqual(obj1, obj2)
         self.assertEqual(obj1, obj)
+
+    @override_settings(CACHALOT_NOW_BUCKET=3600)
+    def test_now_bucket(self):
+        obj = Test.objects.create(datetime='1992-07-02T12:00:00')
+        qs = Test.objects.filter(datetime__lte=Now())
+        with self.assertNumQueries(1):
+            obj1 = qs.get()
+        with self.assertNumQueries(0):
+            obj2 = qs.get()
+        self.assertEqual(obj1, obj2)
+        self.assertEqual(obj1, obj)
+
+        # The queryset itself is unchanged.
+        self.assertIsInstance(qs.query.where.children[0].rhs, Now)
+        self.assert_query_cached(
+            Test.objects.filter(Q(datetime__gt=Now()) | Q(name='test')), [])
+        # Subqueries using `Now()` are still not cached.
+        self.assert_query_cached(
+            Test.objects.filter(owner__in=User.objects.filter(
+                last_login__lte=Now())), after=1)
+
+    @override_settings(CACHALOT_NOW_BUCKET=3600)
+    def test_now_bucket_uncached_queries(self):
+        Test.objects.create(datetime='1992-07-02T12:00:00')
+
+        def assert_uses_now(qs):
+            with CaptureQueriesContext(connection) as captured:
+                list(qs)
+            sql = captured[-1]['sql'].upper()
+            self.assertTrue('NOW' in sql or 'CURRENT_TIMESTAMP' in sql, sql)
+
+        with transaction.atomic():
+            assert_uses_now(
+                Test.objects.filter(datetime__lte=Now()).select_for_update())
+        with self.settings(CACHALOT_UNCACHABLE_TABLES=('cachalot_test',)):
+            assert_uses_now(Test.objects.filter(datetime__lte=Now()))
+        assert_uses_now(Test.objects.filter(
+            datetime__lte=Now(),
+            owner__in=User.objects.filter(last_login__lte=Now())))
@@ -1,20 +1,32 @@
+from threading import Thread
 from time import sleep
-from unittest import skipIf
+from unittest import mock, skipIf
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.cache import DEFAULT_CACHE_ALIAS
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
 from django.core.checks import run_checks, Tags, Warning, Error
-from django.db import connection
+from django.db import connection, transaction
+from django.db.models import Q
 from django.test import TransactionTestCase
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from ..api import invalidate
-from ..settings import SUPPORTED_ONLY, SUPPORTED_DATABASE_ENGINES
+from ..cache import (
+    cachalot_caches, FREQUENCY_SKETCHES, FrequencySketch, ShardedCache)
+from ..settings import (
+    cachalot_settings, SUPPORTED_ONLY, SUPPORTED_DATABASE_ENGINES)
 from .models import Test, TestParent, TestChild
 from .test_utils import TestUtilsMixin
 
 
+PENDING_COMMITS = []
+
+
+def pending_commit_executor(func):
+    PENDING_COMMITS.append(func)
+
+
 class SettingsTestCase(TestUtilsMixin, TransactionTestCase):
     @override_settings(CACHALOT_ENABLED=False)
     def test_decorator(self):
@@ -68,6 +80,207 @@ class SettingsTestCase(TestUtilsMixin, TransactionTestCase):
         with self.settings(CACHALOT_CACHE=other_cache_alias):
             self.assert_query_cached(qs, before=0)
 
+    @skipIf(len(settings.CACHES) == 1, 'We can’t change the cache used '
+                                       'since there’s only one configured.')
+    def test_table_cache(self):
+        other_cache_alias = next(alias for alias in settings.CACHES
+                                 if alias != DEFAULT_CACHE_ALIAS)
+        table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN(
+            connection.alias, Test._meta.db_table)
+        qs = Test.objects.all()
+
+        with self.settings(CACHALOT_TABLE_CACHE=other_cache_alias):
+            caches[other_cache_alias].clear()
+            caches[DEFAULT_CACHE_ALIAS].clear()
+            self.assert_query_cached(qs)
+            self.assertIn(table_cache_key, caches[other_cache_alias])
+            self.assertNotIn(table_cache_key, caches[DEFAULT_CACHE_ALIAS])
+
+            t = Test.objects.create(name='test')
+            self.assert_query_cached(qs, [t])
+
+            invalidate(Test)
+            self.assert_query_cached(qs, [t])
+
+    @skipIf(len(settings.CACHES) == 1, 'We can’t change the cache used '
+                                       'since there’s only one configured.')
+    def test_result_caches(self):
+        other_cache_alias = next(alias for alias in settings.CACHES
+                                 if alias != DEFAULT_CACHE_ALIAS)
+        table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN(
+            connection.alias, Test._meta.db_table)
+        qs = Test.objects.all()
+        query_cache_key = cachalot_settings.CACHALOT_QUERY_KEYGEN(
+            qs.query.get_compiler(connection.alias))
+
+        with self.settings(CACHALOT_RESULT_CACHES={
+                'cachalot.Test': other_cache_alias}):
+            caches[other_cache_alias].clear()
+            caches[DEFAULT_CACHE_ALIAS].clear()
+            self.assert_query_cached(qs)
+            self.assertIn(query_cache_key, caches[other_cache_alias])
+            self.assertNotIn(query_cache_key, caches[DEFAULT_CACHE_ALIAS])
+            self.assertIn(table_cache_key, caches[DEFAULT_CACHE_ALIAS])
+            self.assertNotIn(table_cache_key, caches[other_cache_alias])
+            # Other tables still use `CACHALOT_CACHE`.
+            self.assert_query_cached(User.objects.all())
+
+            t = Test.objects.create(name='test')
+            self.assert_query_cached(qs, [t])
+
+            # A query reading tables mapped to different caches
+            # uses `CACHALOT_CACHE`.
+            with self.settings(CACHALOT_RESULT_CACHES={
+                    'cachalot_test': other_cache_alias,
+                    'auth_user': DEFAULT_CACHE_ALIAS}):
+                qs = Test.objects.filter(owner__username='user')
+                self.assert_query_cached(qs)
+                query_cache_key = cachalot_settings.CACHALOT_QUERY_KEYGEN(
+                    qs.query.get_compiler(connection.alias))
+                self.assertIn(query_cache_key, caches[DEFAULT_CACHE_ALIAS])
+                self.assertNotIn(query_cache_key, caches[other_cache_alias])
+
+    @skipIf(len(settings.CACHES) == 1, 'We can’t change the cache used '
+                                       'since there’s only one configured.')
+    def test_result_caches_invalidate(self):
+        other_cache_alias = next(alias for alias in settings.CACHES
+                                 if alias != DEFAULT_CACHE_ALIAS)
+        qs = Test.objects.all()
+        with self.settings(CACHALOT_RESULT_CACHES={
+                'cachalot_test': other_cache_alias},
+                CACHALOT_INVALIDATE_RAW=False):
+            caches[other_cache_alias].clear()
+            self.assert_query_cached(qs, [])
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO cachalot_test (name, public) "
+                    "VALUES ('test', %s)", [True])
+            self.assert_query_cached(qs, [], before=0)
+
+            # Invalidating the result cache invalidates the table cache keys
+            # its results are checked against.
+            invalidate(Test, cache_alias=other_cache_alias)
+            self.assert_query_cached(qs, [Test.objects.get()])
+
+    @skipIf(len(settings.CACHES) == 1, 'We can’t shard the cache '
+                                       'since there’s only one configured.')
+    def test_cache_shards(self):
+        other_cache_alias = next(alias for alias in settings.CACHES
+                                 if alias != DEFAULT_CACHE_ALIAS)
+        shards = (DEFAULT_CACHE_ALIAS, other_cache_alias)
+
+        with self.settings(CACHALOT_CACHE_SHARDS=shards):
+            for cache_alias in shards:
+                caches[cache_alias].clear()
+            sharded_cache = cachalot_caches.get_cache()
+            self.assertIsInstance(sharded_cache, ShardedCache)
+
+            querysets = [Test.objects.all(), User.objects.all(),
+                         Test.objects.filter(name='test'),
+                         Test.objects.select_related('owner')]
+            for qs in querysets:
+                self.assert_query_cached(qs)
+            keys = [cachalot_settings.CACHALOT_QUERY_KEYGEN(
+                qs.query.get_compiler(connection.alias)) for qs in querysets]
+            keys.extend(cachalot_settings.CACHALOT_TABLE_KEYGEN(
+                connection.alias, table) for table in ('cachalot_test',
+                                                       'auth_user'))
+            for k in keys:
+                cache_alias = sharded_cache.get_cache_alias(k)
+                self.assertIn(k, caches[cache_alias])
+                self.assertNotIn(k, caches[next(
+                    alias for alias in shards if alias != cache_alias)])
+            # One of the caches is read by the calling thread.
+            with mock.patch.object(
+                    sharded_cache.executor, 'submit',
+                    wraps=sharded_cache.executor.submit) as submit:
+                self.assertSetEqual(set(sharded_cache.get_many(keys)),
+                                    set(keys))
+            self.assertEqual(submit.call_count, len({
+                sharded_cache.get_cache_alias(k) for k in keys}) - 1)
+
+            t = Test.objects.create(name='test')
+            self.assert_query_cached(Test.objects.all(), [t])
+            with transaction.atomic():
+                t.delete()
+                self.assert_query_cached(Test.objects.all(), [])
+            self.assert_query_cached(Test.objects.all(), [])
+
+    def test_cache_shards_ring(self):
+        keys = ['key%d' % i for i in range(1000)]
+        sharded_cache = ShardedCache(('a', 'b', 'c'))
+        shards = {k: sharded_cache.get_cache_alias(k) for k in keys}
+        self.assertSetEqual(set(shards.values()), {'a', 'b', 'c'})
+
+        # Adding a shard only moves keys to this shard.
+        sharded_cache = ShardedCache(('a', 'b', 'c', 'd'))
+        moved = [k for k in keys if sharded_cache.get_cache_alias(k)
+                 != shards[k]]
+        self.assertTrue(moved)
+        self.assertSetEqual(
+            {sharded_cache.get_cache_alias(k) for k in moved}, {'d'})
+
+    @override_settings(CACHALOT_HOT_KEYS=1, CACHALOT_HOT_KEY_REPLICAS=3,
+                       CACHALOT_HOT_KEY_SAMPLE_RATE=1)
+    def test_hot_keys(self):
+        FREQUENCY_SKETCHES.clear()
+        cache = cachalot_caches.get_cache()
+        qs = Test.objects.all()
+        query_cache_key = cachalot_settings.CACHALOT_QUERY_KEYGEN(
+            qs.query.get_compiler(connection.alias))
+        replica_cache_keys = ['%s:r%d' % (query_cache_key, i)
+                              for i in range(3)]
+
+        self.assert_query_cached(qs)
+        self.assertTrue(FREQUENCY_SKETCHES[1].is_hot(query_cache_key))
+        self.assertSetEqual(set(cache.get_many(replica_cache_keys)),
+                            set(replica_cache_keys))
+
+        # Replicas are invalidated like any other query result.
+        t = Test.objects.create(name='test')
+        with mock.patch('cachalot.monkey_patch.choice',
+                        return_value=replica_cache_keys[2]):
+            self.assert_query_cached(qs, [t])
+        self.assertListEqual(cache.get(replica_cache_keys[0])[1],
+                             cache.get(query_cache_key)[1])
+
+        # Processes not seeing this query as hot only cache its main key,
+        # which is used to refresh the copies.
+        Test.objects.filter(pk=t.pk).update(name='other')
+        t.name = 'other'
+        with self.settings(CACHALOT_HOT_KEYS=None):
+            self.assert_query_cached(qs, [t])
+        with mock.patch('cachalot.monkey_patch.choice',
+                        return_value=replica_cache_keys[1]):
+            self.assert_query_cached(qs, [t], before=0)
+        self.assertListEqual(
+            [cache.get(k) for k in replica_cache_keys],
+            [cache.get(query_cache_key)] * 3)
+
+        # Another query becomes hot once it is read more often.
+        other_qs = Test.objects.filter(name='other')
+        for _ in range(7):
+            self.assertListEqual(list(other_qs.all()), [t])
+        self.assertFalse(FREQUENCY_SKETCHES[1].is_hot(query_cache_key))
+        with self.assertNumQueries(0):
+            self.assertListEqual(list(other_qs.all()), [t])
+
+    def test_frequency_sketch(self):
+        sketch = FrequencySketch(2, width=64)
+        # A key read once is not hot, even if there is room for it.
+        sketch.add('b')
+        self.assertDictEqual(sketch.hot_keys, {})
+        for k, n in (('a', 5), ('c', 3), ('d', 8)):
+            for _ in range(n):
+                sketch.add(k)
+        self.assertSetEqual(set(sketch.hot_keys), {'a', 'd'})
+
+        # Counters are halved to forget old reads.
+        for _ in range(10 * 64 - 17):
+            sketch.add('e')
+        self.assertTrue(sketch.is_hot('e'))
+        self.assertLess(sketch.hot_keys['e'], 10 * 64)
+
     def test_databases(self):
         qs = Test.objects.all()
         with self.settings(CACHALOT_DATABASES=SUPPORTED_ONLY):
@@ -112,6 +325,24 @@ class SettingsTestCase(TestUtilsMixin, TransactionTestCase):
             with self.assertNumQueries(1):
                 list(Test.objects.all())
 
+    def test_table_timeouts(self):
+        with self.settings(CACHALOT_TABLE_TIMEOUTS={'cachalot_test': 0}):
+            self.assert_query_cached(Test.objects.all(), after=1)
+            self.assert_query_cached(TestParent.objects.all())
+            # Results use the shortest timeout of their tables.
+            self.assert_query_cached(Test.objects.select_related('owner'),
+                                     after=1)
+
+        with self.settings(CACHALOT_TIMEOUT=0,
+                           CACHALOT_TABLE_TIMEOUTS={'cachalot_test': None}):
+            self.assert_query_cached(Test.objects.all())
+            self.assert_query_cached(TestParent.objects.filter(name='test'),
+                                     after=1)
+
+            with transaction.atomic():
+                Test.objects.create(name='test')
+            self.assert_query_cached(Test.objects.all())
+
     def test_cache_random(self):
         qs = Test.objects.order_by('?')
         self.assert_query_cached(qs, after=1, compare_results=False)
@@ -119,6 +350,26 @@ class SettingsTestCase(TestUtilsMixin, TransactionTestCase):
         with self.settings(CACHALOT_CACHE_RANDOM=True):
             self.assert_query_cached(qs)
 
+    @override_settings(CACHALOT_RANDOM_POOL_SIZE=2)
+    def test_random_pool_size(self):
+        Test.objects.create(name='test1')
+        qs = Test.objects.order_by('?')
+        with mock.patch('cachalot.monkey_patch.randrange', return_value=0):
+            self.assert_query_cached(qs, compare_results=False)
+        with mock.patch('cachalot.monkey_patch.randrange', return_value=1):
+            self.assert_query_cached(qs, compare_results=False)
+        with mock.patch('cachalot.monkey_patch.randrange', return_value=0):
+            self.assert_query_cached(qs, compare_results=False, before=0)
+
+        Test.objects.create(name='test2')
+        with mock.patch('cachalot.monkey_patch.randrange', return_value=1):
+            self.assert_query_cached(qs, compare_results=False)
+
+        # Random subqueries are not cached.
+        self.assert_query_cached(
+            Test.objects.filter(pk__in=Test.objects.order_by('?')[:1]),
+            after=1, compare_results=False)
+
     def test_invalidate_raw(self):
         with self.assertNumQueries(1):
             list(Test.objects.all())
@@ -130,6 +381,88 @@ class SettingsTestCase(TestUtilsMixin, TransactionTestCase):
         with self.assertNumQueries(0):
             list(Test.objects.all())
 
+    def test_commit_executor(self):
+        with self.assertNumQueries(1):
+            list(Test.objects.all())
+
+        executor = 'cachalot.tests.settings.pending_commit_executor'
+        with self.settings(CACHALOT_COMMIT_EXECUTOR=executor):
+            with transaction.atomic():
+                with transaction.atomic():
+                    t = Test.objects.create(name='test')
+                self.assertListEqual(PENDING_COMMITS, [])
+            self.assertEqual(len(PENDING_COMMITS), 1)
+            with self.assertNumQueries(0):
+                self.assertListEqual(list(Test.objects.all()), [])
+
+            PENDING_COMMITS.pop()()
+            with self.assertNumQueries(1):
+                self.assertListEqual(list(Test.objects.all()), [t])
+
+            try:
+                with transaction.atomic():
+                    Test.objects.create(name='test')
+                    raise ZeroDivisionError
+            except ZeroDivisionError:
+                pass
+            self.assertListEqual(PENDING_COMMITS, [])
+            with self.assertNumQueries(0):
+                self.assertListEqual(list(Test.objects.all()), [t])
+
+    def test_commit_executor_thread(self):
+        with self.assertNumQueries(1):
+            list(Test.objects.all())
+
+        cache = caches[DEFAULT_CACHE_ALIAS]
+        executor = 'cachalot.tests.settings.pending_commit_executor'
+        with self.settings(CACHALOT_COMMIT_EXECUTOR=executor):
+            with transaction.atomic():
+                t = Test.objects.create(name='test')
+            # The cache of the thread running the transaction
+            # is not used by the executor thread.
+            with mock.patch.object(cache, 'set_many') as set_many:
+                thread = Thread(target=PENDING_COMMITS.pop())
+                thread.start()
+                thread.join()
+            set_many.assert_not_called()
+            with self.assertNumQueries(1):
+                self.assertListEqual(list(Test.objects.all()), [t])
+
+    def test_atomic_max_entries(self):
+        with self.settings(CACHALOT_ATOMIC_MAX_ENTRIES=2):
+            with self.assertLogs('cachalot.cache', 'DEBUG') as logs:
+                with transaction.atomic():
+                    with self.assertNumQueries(3):
+                        list(Test.objects.all())
+                        list(TestParent.objects.all())
+                        list(User.objects.all())
+                    with self.assertNumQueries(0):
+                        list(User.objects.all())
+                        list(TestParent.objects.all())
+                    with self.assertNumQueries(1):
+                        list(Test.objects.all())
+                    with self.assertNumQueries(0):
+                        list(Test.objects.all())
+                        list(TestParent.objects.all())
+        self.assertIn('kept up to 2 query results', logs.output[0])
+        self.assertIn('(2 evicted)', logs.output[0])
+
+        # Evicted results are not kept by undo logs either.
+        with self.settings(CACHALOT_ATOMIC_MAX_ENTRIES=2):
+            with transaction.atomic():
+                for i in range(20):
+                    list(Test.objects.all())
+                    Test.objects.create(name='test%d' % i)
+                atomic_cache = cachalot_caches.get_cache(
+                    db_alias=connection.alias)
+                self.assertLessEqual(len(atomic_cache.results), 2)
+                self.assertListEqual(atomic_cache.undo_logs, [])
+                with transaction.atomic():
+                    list(Test.objects.all())
+                    self.assertEqual(
+                        sum(len(undo_log)
+                            for _, undo_log in atomic_cache.undo_logs), 1)
+
     def test_only_cachable_tables(self):
         with self.settings(CACHALOT_ONLY_CACHABLE_TABLES=('cachalot_test',)):
             self.assert_query_cached(Test.objects.all())
@@ -163,6 +496,280 @@ class SettingsTestCase(TestUtilsMixin, TransactionTestCase):
         with self.settings(CACHALOT_UNCACHABLE_TABLES=('cachalot_test',)):
             self.assert_query_cached(qs, after=1)
 
+    @override_settings(CACHALOT_ROW_LEVEL_TABLES=('cachalot_test',))
+    def test_row_level_tables(self):
+        t1 = Test.objects.create(name='test1')
+        t2 = Test.objects.create(name='test2')
+        qs1 = Test.objects.filter(pk=t1.pk)
+        qs2 = Test.objects.filter(pk=t2.pk)
+        qs = Test.objects.all()
+        self.assert_query_cached(qs1, [t1])
+        self.assert_query_cached(qs2, [t2])
+        self.assert_query_cached(qs, [t1, t2])
+
+        t2.name = 'test2 updated'
+        t2.save()
+        self.assert_query_cached(qs1, [t1], before=0)
+        self.assert_query_cached(qs2, [t2])
+        self.assert_query_cached(qs, [t1, t2])
+
+        Test.objects.filter(pk__in=[t2.pk]).update(public=True)
+        self.assert_query_cached(qs1, [t1], before=0)
+        self.assert_query_cached(qs2)
+        self.assert_query_cached(qs)
+
+        with transaction.atomic():
+            t2.delete()
+            self.assert_query_cached(qs1, [t1], before=0)
+            self.assert_query_cached(qs2, [])
+        self.assert_query_cached(qs1, [t1], before=0)
+        self.assert_query_cached(qs2, [])
+        self.assert_query_cached(qs, [t1])
+
+        # Rows with explicit primary keys are known before being created.
+        t3 = Test.objects.create(pk=t1.pk + 100, name='test3')
+        self.assert_query_cached(qs1, [t1], before=0)
+        self.assert_query_cached(Test.objects.filter(pk=t3.pk), [t3])
+
+        # Writes of unknown rows invalidate all the rows of the table.
+        Test.objects.filter(name='test3').update(public=True)
+        self.assert_query_cached(qs1, [t1])
+        Test.objects.create(name='test4')
+        self.assert_query_cached(qs1, [t1])
+        invalidate(Test)
+        self.assert_query_cached(qs1, [t1])
+
+    @override_settings(CACHALOT_PARTITION_COLUMNS={'cachalot_test': 'owner_id'})
+    def test_partition_columns(self):
+        u1 = User.objects.create_user('user1')
+        u2 = User.objects.create_user('user2')
+        qs1 = Test.objects.filter(owner=u1)
+        qs2 = Test.objects.filter(owner_id=u2.pk)
+        qs = Test.objects.all()
+        self.assert_query_cached(qs1, [])
+        self.assert_query_cached(qs2, [])
+        self.assert_query_cached(qs, [])
+
+        t1 = Test.objects.create(name='test1', owner=u1)
+        self.assert_query_cached(qs1, [t1])
+        self.assert_query_cached(qs2, [], before=0)
+        self.assert_query_cached(qs, [t1])
+
+        Test.objects.filter(owner=u1).update(name='test1 updated')
+        self.assert_query_cached(qs1)
+        self.assert_query_cached(qs2, [], before=0)
+        self.assert_query_cached(qs)
+
+        # Rows moved to another partition invalidate both partitions.
+        Test.objects.filter(owner=u1).update(owner_id=u2.pk)
+        self.assert_query_cached(qs1, [])
+        self.assert_query_cached(qs2, [t1])
+
+        # Writes that do not reveal the partition invalidate all of them.
+        t1.owner = u2
+        t1.save()
+        self.assert_query_cached(qs1, [])
+        self.assert_query_cached(qs2, [t1])
+
+    @override_settings(CACHALOT_COLUMN_LEVEL_TABLES=('cachalot_test',))
+    def test_column_level_tables(self):
+        Test.objects.create(name='test1')
+        qs_name = Test.objects.values_list('name', flat=True)
+        # The default ordering of `Test` would also use the name.
+        qs_public = Test.objects.filter(public=True).order_by().values_list(
+            'pk', flat=True)
+        qs = Test.objects.all()
+        self.assert_query_cached(qs_name, ['test1'])
+        self.assert_query_cached(qs_public, [])
+        self.assert_query_cached(qs)
+
+        Test.objects.update(name='test1 updated')
+        self.assert_query_cached(qs_name, ['test1 updated'])
+        self.assert_query_cached(qs_public, [], before=0)
+        self.assert_query_cached(qs)
+
+        Test.objects.update(public=True)
+        self.assert_query_cached(qs_name, ['test1 updated'], before=0)
+        self.assert_query_cached(qs_public)
+        self.assert_query_cached(qs)
+
+        # A new row changes the result of any query.
+        Test.objects.create(name='test2')
+        self.assert_query_cached(qs_name, ['test1 updated', 'test2'])
+        self.assert_query_cached(qs_public)
+        self.assert_query_cached(qs)
+
+    @override_settings(CACHALOT_SPLIT_IN_QUERIES=True)
+    def test_split_in_queries(self):
+        t1 = Test.objects.create(name='test1')
+        t2 = Test.objects.create(name='test2')
+        t3 = Test.objects.create(name='test3')
+        # The default ordering of `Test` would prevent splitting queries.
+        qs = Test.objects.order_by().values_list('pk', 'name')
+
+        with self.assertNumQueries(1):
+            self.assertDictEqual(dict(qs.filter(pk__in=[t1.pk, t2.pk])),
+                                 {t1.pk: 'test1', t2.pk: 'test2'})
+        with self.assertNumQueries(0):
+            self.assertDictEqual(dict(qs.filter(pk__in=[t2.pk, t1.pk])),
+                                 {t1.pk: 'test1', t2.pk: 'test2'})
+        # Only the missing values are queried.
+        with CaptureQueriesContext(connection) as captured:
+            self.assertDictEqual(
+                dict(qs.filter(pk__in=[t1.pk, t3.pk, t1.pk + 100])),
+                {t1.pk: 'test1', t3.pk: 'test3'})
+        self.assertEqual(len(captured), 1)
+        self.assertIn('IN (%s, %s)' % (t3.pk, t1.pk + 100),
+                      captured[0]['sql'])
+        with self.assertNumQueries(0):
+            self.assertDictEqual(
+                dict(qs.filter(pk__in=[t1.pk + 100, t2.pk, t3.pk])),
+                {t2.pk: 'test2', t3.pk: 'test3'})
+        with self.assertNumQueries(1):
+            self.assertDictEqual(
+                dict(qs.filter(pk__in=[t1.pk, t2.pk], public=True)), {})
+
+        Test.objects.filter(pk=t1.pk).update(name='test1 updated')
+        with self.assertNumQueries(1):
+            self.assertDictEqual(dict(qs.filter(pk__in=[t1.pk, t2.pk])),
+                                 {t1.pk: 'test1 updated', t2.pk: 'test2'})
+
+        # Splitting different columns gives different cache keys.
+        qs = Test.objects.order_by().values_list('pk', 'owner', 'name')
+        values = [t1.pk, t1.pk + 100]
+        self.assertListEqual(
+            list(qs.filter(pk__in=values, owner__isnull=True)),
+            [(t1.pk, None, 'test1 updated')])
+        self.assertListEqual(
+            list(qs.filter(pk__isnull=True, owner__in=values)), [])
+
+        # The filtered column must be selected.
+        qs = Test.objects.order_by().values_list('name', flat=True)
+        self.assert_query_cached(qs.filter(pk__in=[t1.pk, t2.pk]))
+        self.assert_query_cached(qs.filter(pk__in=[t2.pk, t1.pk]))
+        # Ordered queries are not split either.
+        qs = Test.objects.values_list('name', flat=True)
+        self.assert_query_cached(qs.filter(pk__in=[t1.pk, t2.pk]),
+                                 ['test1 updated', 'test2'])
+        self.assert_query_cached(qs.filter(pk__in=[t2.pk, t1.pk]))
+
+    @override_settings(CACHALOT_SLICE_WINDOW=4)
+    def test_slice_window(self):
+        Test.objects.bulk_create([Test(name='test%s' % i) for i in range(6)])
+        qs = Test.objects.values_list('name', flat=True)
+
+        self.assert_query_cached(qs[:2], ['test0', 'test1'])
+        self.assert_query_cached(qs[2:4], ['test2', 'test3'], before=0)
+        self.assert_query_cached(qs[1:3], ['test1', 'test2'], before=0)
+        # This slice overlaps two windows.
+        self.assert_query_cached(qs[3:5], ['test3', 'test4'])
+        self.assert_query_cached(qs[4:6], ['test4', 'test5'])
+        self.assert_query_cached(qs[6:8], [], before=0)
+
+        self.assert_query_cached(qs, ['test%s' % i for i in range(6)])
+        self.assert_query_cached(qs[1:5], ['test1', 'test2', 'test3',
+                                           'test4'], before=0)
+        self.assert_query_cached(qs[5:], ['test5'], before=0)
+
+        Test.objects.create(name='test6')
+        self.assert_query_cached(qs[5:], ['test5', 'test6'])
+        self.assert_query_cached(qs[4:6], ['test4', 'test5'])
+        self.assert_query_cached(qs[6:8], ['test6'], before=0)
+        self.assert_query_cached(qs[:2], ['test0', 'test1'])
+
+    @override_settings(CACHALOT_DERIVE_MAX_ROWS=2)
+    def test_derive_max_rows(self):
+        qs = Test.objects.filter(public=False)
+        self.assert_query_cached(qs, [])
+        with self.assertNumQueries(0):
+            self.assertEqual(qs.count(), 0)
+            self.assertFalse(qs.exists())
+
+        t1 = Test.objects.create(name='test1')
+        with self.assertNumQueries(1):
+            self.assertTrue(qs.exists())
+        self.assert_query_cached(qs, [t1])
+        with self.assertNumQueries(0):
+            self.assertEqual(qs.count(), 1)
+            self.assertTrue(qs.exists())
+
+        # The cached result has too many rows.
+        t2 = Test.objects.create(name='test2')
+        t3 = Test.objects.create(name='test3')
+        self.assert_query_cached(qs, [t1, t2, t3])
+        with self.assertNumQueries(1):
+            self.assertEqual(qs.count(), 3)
+
+    @override_settings(CACHALOT_QUERY_KEYGEN=
+                       'cachalot.utils.get_normalized_query_cache_key')
+    def test_normalized_query_keygen(self):
+        t1 = Test.objects.create(name='test1', public=True)
+        t2 = Test.objects.create(name='test2', public=True)
+        self.assert_query_cached(
+            Test.objects.filter(pk__in=[t2.pk, t1.pk]), [t1, t2])
+        self.assert_query_cached(
+            Test.objects.filter(pk__in=[t1.pk, t2.pk, t1.pk]), [t1, t2],
+            before=0)
+        self.assert_query_cached(
+            Test.objects.filter(name__startswith='test').filter(public=True),
+            [t1, t2])
+        self.assert_query_cached(
+            Test.objects.filter(public=True).filter(name__startswith='test'),
+            [t1, t2], before=0)
+        self.assert_query_cached(
+            Test.objects.filter(Q(public=True) | Q(pk__in=[t2.pk, t1.pk])),
+            [t1, t2])
+        self.assert_query_cached(
+            Test.objects.filter(Q(pk__in=[t1.pk, t2.pk]) | Q(public=True)),
+            [t1, t2], before=0)
+
+        # The order of the results of unordered queries may change.
+        qs = Test.objects.order_by()
+        self.assert_query_cached(qs.filter(pk__in=[t2.pk, t1.pk]))
+        self.assert_query_cached(qs.filter(pk__in=[t1.pk, t2.pk]))
+
+    @override_settings(
+        CACHALOT_QUERY_KEYGEN='cachalot.utils.get_hash_tagged_query_cache_key',
+        CACHALOT_TABLE_KEYGEN='cachalot.utils.get_hash_tagged_table_cache_key',
+        CACHALOT_HASH_TAG_GROUPS={'cachalot.Test': 'shop',
+                                  'auth_user': 'shop', 'auth_group': ''},
+        CACHALOT_SPLIT_IN_QUERIES=True)
+    def test_hash_tagged_keygens(self):
+        db_alias = connection.alias
+        get_table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN
+        shop_tag = '{%s:shop}' % db_alias
+        self.assertTrue(get_table_cache_key(
+            db_alias, 'cachalot_test').startswith(shop_tag))
+        self.assertTrue(get_table_cache_key(
+            db_alias, 'auth_user').startswith(shop_tag))
+        # Tables without a group have their own hash tag.
+        self.assertTrue(get_table_cache_key(db_alias, 'auth_permission')
+                        .startswith('{%s:auth_permission}' % db_alias))
+        self.assertTrue(get_table_cache_key(db_alias, 'auth_group')
+                        .startswith('{%s}' % db_alias))
+
+        cache = cachalot_caches.get_cache()
+        qs = Test.objects.filter(owner__username='user')
+        self.assert_query_cached(qs)
+        query_cache_key = cachalot_settings.CACHALOT_QUERY_KEYGEN(
+            qs.query.get_compiler(db_alias))
+        self.assertTrue(query_cache_key.startswith(shop_tag))
+        self.assertIn(query_cache_key, cache)
+
+        t1 = Test.objects.create(name='test1')
+        t2 = Test.objects.create(name='test2')
+        # The rows of each value of a split query use the same hash tag.
+        qs = Test.objects.order_by().filter(
+            pk__in=[t1.pk, t2.pk]).values_list('pk', 'name')
+        with mock.patch.object(cache, 'set_many',
+                               wraps=cache.set_many) as set_many:
+            self.assert_query_cached(qs, compare_results=False)
+        keys = {k for args, kwargs in set_many.call_args_list
+                for k in args[0]}
+        self.assertEqual(len(keys), 2)
+        for k in keys:
+            self.assertTrue(k.startswith(shop_tag))
+
     def test_only_cachable_and_uncachable_table(self):
         with self.settings(
                 CACHALOT_ONLY_CACHABLE_TABLES=('cachalot_test',
@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from django.db import transaction, connection, IntegrityError
 from django.test import TransactionTestCase, skipUnlessDBFeature
 
+from ..cache import cachalot_caches
 from .models import Test
 from .test_utils import TestUtilsMixin
 
@@ -168,6 +169,54 @@ class AtomicTestCase(TestUtilsMixin, TransactionTestCase):
             data3 = list(Test.objects.all())
         self.assertListEqual(data3, [t1])
 
+    def test_unused_levels_nested_atomic(self):
+        with self.assertNumQueries(1):
+            list(Test.objects.all())
+        with transaction.atomic():
+            with transaction.atomic():
+                self.assertDictEqual(
+                    cachalot_caches.atomic_caches[connection.alias], {})
+                try:
+                    with transaction.atomic():
+                        with transaction.atomic():
+                            Test.objects.create(name='test')
+                        raise ZeroDivisionError
+                except ZeroDivisionError:
+                    pass
+                with self.assertNumQueries(0):
+                    self.assertListEqual(list(Test.objects.all()), [])
+                with transaction.atomic():
+                    with transaction.atomic():
+                        t = Test.objects.create(name='test')
+                with self.assertNumQueries(1):
+                    self.assertListEqual(list(Test.objects.all()), [t])
+        with self.assertNumQueries(1):
+            self.assertListEqual(list(Test.objects.all()), [t])
+
+    def test_rollback_restores_savepoint_parent(self):
+        with transaction.atomic():
+            with self.assertNumQueries(1):
+                data1 = list(Test.objects.all())
+            for i in range(3):
+                try:
+                    with transaction.atomic():
+                        Test.objects.create(name='test%d' % i)
+                        with self.assertNumQueries(1):
+                            data2 = list(Test.objects.all())
+                        self.assertEqual(len(data2), 1)
+                        raise ZeroDivisionError
+                except ZeroDivisionError:
+                    pass
+                with self.assertNumQueries(0):
+                    data3 = list(Test.objects.all())
+                self.assertListEqual(data3, data1)
+            with transaction.atomic():
+                with transaction.atomic():
+                    t = Test.objects.create(name='test')
+            with self.assertNumQueries(1):
+                data4 = list(Test.objects.all())
+            self.assertListEqual(data4, [t])
+
     @skipUnlessDBFeature('can_defer_constraint_checks')
     def test_deferred_error(self):
         """
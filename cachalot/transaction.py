@@ -1,34 +1,152 @@
+from collections import OrderedDict
+from time import time
+
 from .settings import cachalot_settings
 
 
+MISSING = object()
+INVALIDATED = object()
+
+
 class AtomicCache(dict):
-    def __init__(self, parent_cache, db_alias):
+    """
+    Stores what is cached and invalidated during a whole transaction,
+    for a given cache and database.
+
+    Instead of copying data from a savepoint to its parent, all savepoints
+    share this dict and each of them keeps an undo log of its changes.
+    Committing a savepoint only attaches its undo log to the log of its
+    parent, and rolling it back replays its log backwards.
+
+    If ``CACHALOT_ATOMIC_MAX_ENTRIES`` is set, the least recently used
+    query results are evicted above this number.  Invalidation timestamps
+    are never evicted, so an evicted query result is only cached again
+    the next time it is executed.
+    """
+
+    def __init__(self, parent_cache, cache_alias, db_alias, depth):
         super(AtomicCache, self).__init__()
         self.parent_cache = parent_cache
+        self.cache_alias = cache_alias
         self.db_alias = db_alias
-        self.to_be_invalidated = set()
+        self.depth = depth
+        # Invalidated table keys, mapped to their table.
+        self.to_be_invalidated = {}
+        # Keys that do not use `CACHALOT_TIMEOUT`, mapped to their timeout.
+        self.timeouts = {}
+        # Stack of `(depth, undo_log)`, only for the atomic levels
+        # that changed something.
+        self.undo_logs = []
+        self.max_entries = cachalot_settings.CACHALOT_ATOMIC_MAX_ENTRIES
+        # Query results keys, from the least to the most recently used.
+        self.results = OrderedDict()
+        self.peak_results = 0
+        self.evictions = 0
+
+    def get_undo_log(self):
+        """
+        Returns the undo log of the current atomic level, or ``None``
+        for the outermost one since rolling it back discards
+        the whole atomic cache.
+        """
+        if self.depth <= 1:
+            return None
+        if not self.undo_logs or self.undo_logs[-1][0] != self.depth:
+            self.undo_logs.append((self.depth, []))
+        return self.undo_logs[-1][1]
 
     def set(self, k, v, timeout):
-        self[k] = v
+        self.set_many({k: v}, timeout)
 
     def get_many(self, keys):
         data = {k: self[k] for k in keys if k in self}
+        for k in data:
+            if k in self.results:
+                self.results.move_to_end(k)
         missing_keys = set(keys)
         missing_keys.difference_update(data)
         data.update(self.parent_cache.get_many(missing_keys))
         return data
 
     def set_many(self, data, timeout):
-        self.update(data)
+        if timeout != cachalot_settings.CACHALOT_TIMEOUT:
+            self.timeouts.update(dict.fromkeys(data, timeout))
+        elif self.timeouts:
+            for k in data:
+                self.timeouts.pop(k, None)
+        undo_log = self.get_undo_log()
+        for k, v in data.items():
+            if undo_log is not None:
+                undo_log.append((k, dict.get(self, k, MISSING)))
+            self[k] = v
+            if v.__class__ is tuple:
+                self.results[k] = None
+                self.results.move_to_end(k)
+        self.evict()
+
+    def evict(self):
+        if self.max_entries is not None:
+            while len(self.results) > self.max_entries:
+                del self[self.results.popitem(last=False)[0]]
+                self.evictions += 1
+        if len(self.results) > self.peak_results:
+            self.peak_results = len(self.results)
+
+    def add_to_be_invalidated(self, keys):
+        undo_log = self.get_undo_log()
+        for k, table in keys.items():
+            if k not in self.to_be_invalidated:
+                if undo_log is not None:
+                    undo_log.append((INVALIDATED, k))
+                self.to_be_invalidated[k] = table
+
+    def enter_atomic(self):
+        self.depth += 1
+
+    def exit_atomic(self, commit):
+        depth = self.depth
+        self.depth -= 1
+        if not self.undo_logs or self.undo_logs[-1][0] != depth:
+            return
+        undo_log = self.undo_logs.pop()[1]
+        if not commit:
+            self.undo(undo_log)
+            self.evict()
+        elif self.depth > 1:
+            self.get_undo_log().append(undo_log)
+
+    def undo(self, undo_log):
+        for entry in reversed(undo_log):
+            if entry.__class__ is list:
+                self.undo(entry)
+                continue
+            k, v = entry
+            if k is INVALIDATED:
+                del self.to_be_invalidated[v]
+            elif v is MISSING:
+                # The key may have been evicted since then.
+                self.pop(k, None)
+                self.results.pop(k, None)
+            else:
+                self[k] = v
+                if v.__class__ is tuple:
+                    self.results[k] = None
 
-    def commit(self):
+    def commit(self, parent_cache=None):
+        """
+        Sends what was cached and invalidated to ``parent_cache``,
+        by default the cache used during the transaction.
+        """
         # We import this here to avoid a circular import issue.
-        from .utils import _invalidate_tables
+        from .utils import _set_many
 
+        if parent_cache is None:
+            parent_cache = self.parent_cache
         if self:
-            self.parent_cache.set_many(
-                self, cachalot_settings.CACHALOT_TIMEOUT)
+            _set_many(parent_cache, self, self.timeouts)
         # The previous `set_many` is not enough.  The parent cache needs to be
         # invalidated in case another transaction occurred in the meantime.
-        _invalidate_tables(self.parent_cache, self.db_alias,
-                           self.to_be_invalidated)
+        if self.to_be_invalidated:
+            now = time()
+            _set_many(parent_cache,
+                      {k: now for k in self.to_be_invalidated}, self.timeouts)
@@ -1,15 +1,26 @@
 import datetime
+from collections import defaultdict
 from decimal import Decimal
+from functools import lru_cache
 from hashlib import sha1
 from time import time
 from uuid import UUID
 
+from django.apps import apps
+from django.conf import settings
 from django.contrib.postgres.functions import TransactionNow
 from django.db import connections
-from django.db.models import QuerySet, Subquery, Exists
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db.models import Prefetch, QuerySet, Subquery, Exists
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import Col
 from django.db.models.functions import Now
+from django.db.models.lookups import Exact, In, IsNull
 from django.db.models.sql import Query, AggregateQuery
-from django.db.models.sql.where import ExtraWhere, WhereNode, NothingNode
+from django.db.models.sql.subqueries import InsertQuery, UpdateQuery
+from django.db.models.sql.where import (
+    AND, ExtraWhere, WhereNode, NothingNode)
+from django.utils import timezone
 
 from .settings import ITERABLES, cachalot_settings
 from .transaction import AtomicCache
@@ -28,6 +39,11 @@ CACHABLE_PARAM_TYPES = {
     datetime.date, datetime.time, datetime.datetime, datetime.timedelta, UUID,
 }
 UNCACHABLE_FUNCS = {Now, TransactionNow}
+# Parameter classes not represented with `str` in cache keys,
+# mapped to the function giving their representation.
+PARAM_ENCODERS = {}
+FRAGMENT_VALUE_TYPES = {int, str, UUID}
+SPLIT_VALUE_TYPES = {int, str}
 
 try:
     # TODO Drop after Dj30 drop
@@ -49,15 +65,38 @@ else:
 
 
 def check_parameter_types(params):
-    for p in params:
-        cl = p.__class__
-        if cl not in CACHABLE_PARAM_TYPES:
-            if cl in ITERABLES:
-                check_parameter_types(p)
-            elif cl is dict:
-                check_parameter_types(p.items())
-            else:
-                raise UncachableQuery
+    # Each class is only checked once, which matters for long IN lists.
+    classes = {p.__class__ for p in params}
+    classes.difference_update(CACHABLE_PARAM_TYPES)
+    for cl in classes:
+        if cl in ITERABLES:
+            for p in params:
+                if p.__class__ is cl:
+                    check_parameter_types(p)
+        elif cl is dict:
+            for p in params:
+                if p.__class__ is dict:
+                    check_parameter_types(p.items())
+        else:
+            raise UncachableQuery
+
+
+def _encode_param(p):
+    encoder = PARAM_ENCODERS.get(p.__class__)
+    if encoder is not None:
+        return encoder(p)
+    if PARAM_ENCODERS and p.__class__ in ITERABLES:
+        return str([_encode_param(v) for v in p])
+    return str(p)
+
+
+def _encode_params(params):
+    """
+    Returns the strings representing ``params`` in cache keys.
+    """
+    if not PARAM_ENCODERS:
+        return [str(p) for p in params]
+    return [_encode_param(p) for p in params]
 
 
 def get_query_cache_key(compiler):
@@ -75,11 +114,78 @@ def get_query_cache_key(compiler):
     """
     sql, params = compiler.as_sql()
     check_parameter_types(params)
-    cache_key = '%s:%s:%s' % (compiler.using, sql,
-                              [str(p) for p in params])
+    cache_key = '%s:%s:%s' % (compiler.using, sql, _encode_params(params))
     return sha1(cache_key.encode('utf-8')).hexdigest()
 
 
+def _is_ordered(query):
+    """
+    Returns whether reordering the WHERE clause of ``query``
+    cannot change the order of its results.
+    """
+    if isinstance(query, AggregateQuery):
+        return True
+    if query.order_by or query.extra_order_by:
+        return True
+    if query.default_ordering and query.model is not None \
+            and query.get_meta().ordering:
+        return True
+    # Aggregations without GROUP BY give a single row.
+    return (query.group_by is None and not query.select
+            and not query.default_cols and bool(query.annotation_select)
+            and all(a.contains_aggregate
+                    for a in query.annotation_select.values()))
+
+
+def _normalize_where(compiler, node):
+    """
+    Sorts in place the children of ``node`` and the literal values
+    of its ``__in`` lookups, recursively.
+    """
+    for i, child in enumerate(node.children):
+        if isinstance(child, WhereNode):
+            _normalize_where(compiler, child)
+        elif isinstance(child, In) and child.rhs.__class__ in ITERABLES:
+            try:
+                values = sorted(set(child.rhs))
+            except TypeError:
+                continue
+            node.children[i] = child.__class__(child.lhs, values)
+
+    def get_sort_key(child):
+        try:
+            sql, params = compiler.compile(child)
+        except EmptyResultSet:
+            return '', []
+        return sql, _encode_params(params)
+
+    node.children.sort(key=get_sort_key)
+
+
+def get_normalized_query_cache_key(compiler):
+    """
+    Generates a cache key from a SQLCompiler, like
+    ``get_query_cache_key``, but the same for ordered queries only differing
+    by the order of their filters or of the values of their ``__in``
+    lookups, like ``filter(id__in=[3, 1, 2])`` and ``filter(id__in=[1, 2, 3])``.
+
+    :arg compiler: A SQLCompiler that will generate the SQL query
+    :type compiler: django.db.models.sql.compiler.SQLCompiler
+    :return: A cache key
+    :rtype: int
+    """
+    query = compiler.query
+    if not _is_ordered(query):
+        return get_query_cache_key(compiler)
+    # Like for any cache key, `compiler` must be set up as if it was
+    # executed, since the cached result is used with it.
+    compiler.as_sql()
+    query = query.clone()
+    normalized_compiler = query.get_compiler(compiler.using)
+    _normalize_where(normalized_compiler, query.where)
+    return get_query_cache_key(normalized_compiler)
+
+
 def get_table_cache_key(db_alias, table):
     """
     Generates a cache key from a SQL table.
@@ -95,6 +201,69 @@ def get_table_cache_key(db_alias, table):
     return sha1(cache_key.encode('utf-8')).hexdigest()
 
 
+def _get_hash_tag(db_alias, table):
+    """
+    Returns the Redis Cluster hash tag of the keys about ``table``,
+    which may also be the name of one of its fragments.
+    """
+    groups = cachalot_settings.CACHALOT_HASH_TAG_GROUPS
+    group = groups.get(table)
+    if group is None:
+        # Fragments use the hash tag of their table.
+        table = table.partition(':')[0].partition('.')[0]
+        group = groups.get(table)
+    if group is None:
+        # Each table has its own slot, to spread the load over the cluster.
+        group = table
+    if not group:
+        return '{%s}' % db_alias
+    return '{%s:%s}' % (db_alias, group)
+
+
+def get_hash_tagged_query_cache_key(compiler):
+    """
+    Generates a cache key from a SQLCompiler, like ``get_query_cache_key``,
+    prefixed with the Redis Cluster hash tag of its main table so that it
+    is stored in the same slot as its table cache keys generated by
+    ``get_hash_tagged_table_cache_key``.
+
+    :arg compiler: A SQLCompiler that will generate the SQL query
+    :type compiler: django.db.models.sql.compiler.SQLCompiler
+    :return: A cache key
+    :rtype: str
+    """
+    query = compiler.query
+    table = '' if query.model is None else query.get_meta().db_table
+    return _get_hash_tag(compiler.using, table) + get_query_cache_key(
+        compiler)
+
+
+def get_hash_tagged_table_cache_key(db_alias, table):
+    """
+    Generates a cache key from a SQL table, like ``get_table_cache_key``,
+    prefixed with the Redis Cluster hash tag of its group
+    from ``CACHALOT_HASH_TAG_GROUPS``, or of the table itself.
+
+    :arg db_alias: Alias of the used database
+    :type db_alias: str or unicode
+    :arg table: Name of the SQL table
+    :type table: str or unicode
+    :return: A cache key
+    :rtype: str
+    """
+    return _get_hash_tag(db_alias, table) + get_table_cache_key(
+        db_alias, table)
+
+
+def _get_hash_tag_prefix(cache_key):
+    """
+    Returns the hash tag ``cache_key`` starts with, if any.
+    """
+    if cache_key[:1] == '{':
+        return cache_key[:cache_key.find('}') + 1]
+    return ''
+
+
 def _get_tables_from_sql(connection, lowercased_sql):
     return {t for t in connection.introspection.django_table_names()
             if t in lowercased_sql}
@@ -121,6 +290,48 @@ def _find_subqueries_in_where(children):
                 raise UncachableQuery
 
 
+def _uses_now(node):
+    for child in node.children:
+        if isinstance(child, WhereNode):
+            if _uses_now(child):
+                return True
+        elif getattr(child, 'rhs', None).__class__ in UNCACHABLE_FUNCS:
+            return True
+    return False
+
+
+def _replace_now(node, now):
+    for i, child in enumerate(node.children):
+        if isinstance(child, WhereNode):
+            _replace_now(child, now)
+        elif getattr(child, 'rhs', None).__class__ in UNCACHABLE_FUNCS:
+            node.children[i] = child.__class__(child.lhs, now)
+
+
+def _get_query_with_bucketed_now(query):
+    """
+    Returns a copy of ``query`` where ``Now()`` and ``TransactionNow()``
+    are replaced in the WHERE clause by the current time rounded down
+    to ``CACHALOT_NOW_BUCKET`` seconds, or ``None`` if they are not used.
+    """
+    if not _uses_now(query.where):
+        return
+    bucket = cachalot_settings.CACHALOT_NOW_BUCKET
+    timestamp = time()
+    now = datetime.datetime.fromtimestamp(
+        timestamp - timestamp % bucket,
+        timezone.utc if settings.USE_TZ else None)
+    query = query.clone()
+    _replace_now(query.where, now)
+    if 'timeout' not in getattr(query, 'cachalot_options', {}):
+        # The result is useless once the bucket is over.
+        query.cachalot_options = dict(
+            getattr(query, 'cachalot_options', {}),
+            timeout=_get_shortest_timeout(
+                (bucket, cachalot_settings.CACHALOT_TIMEOUT)))
+    return query
+
+
 def is_cachable(table):
     whitelist = cachalot_settings.CACHALOT_ONLY_CACHABLE_TABLES
     if whitelist and table not in whitelist:
@@ -143,10 +354,12 @@ def filter_cachable(tables):
     return tables
 
 
-def _get_tables(db_alias, query):
+def _get_tables(db_alias, query, is_subquery=False):
     if query.select_for_update or (
             not cachalot_settings.CACHALOT_CACHE_RANDOM
-            and '?' in query.order_by):
+            and '?' in query.order_by
+            and (is_subquery
+                 or cachalot_settings.CACHALOT_RANDOM_POOL_SIZE is None)):
         raise UncachableQuery
 
     try:
@@ -160,12 +373,14 @@ def _get_tables(db_alias, query):
             if isinstance(annotation, Subquery):
                 # Django 2.2+ removed queryset in favor of simply using query
                 try:
-                    tables.update(_get_tables(db_alias, annotation.queryset.query))
+                    tables.update(_get_tables(
+                        db_alias, annotation.queryset.query, True))
                 except AttributeError:
-                    tables.update(_get_tables(db_alias, annotation.query))
+                    tables.update(
+                        _get_tables(db_alias, annotation.query, True))
         # Gets tables in WHERE subqueries.
         for subquery in _find_subqueries_in_where(query.where.children):
-            tables.update(_get_tables(db_alias, subquery))
+            tables.update(_get_tables(db_alias, subquery, True))
         # Gets tables in HAVING subqueries.
         if isinstance(query, AggregateQuery):
             tables.update(
@@ -174,7 +389,7 @@ def _get_tables(db_alias, query):
         # using `.union`, `.intersection`, or `difference`.
         if query.combined_queries:
             for combined_query in query.combined_queries:
-                tables.update(_get_tables(db_alias, combined_query))
+                tables.update(_get_tables(db_alias, combined_query, True))
     except IsRawQuery:
         sql = query.get_compiler(db_alias).as_sql()[0].lower()
         tables = _get_tables_from_sql(connections[db_alias], sql)
@@ -184,22 +399,381 @@ def _get_tables(db_alias, query):
     return tables
 
 
+def _get_whole_table(table):
+    """
+    Name given to the table key of a table with fragments that is only
+    invalidated when rows of this table are written without knowing which.
+    """
+    return '%s:*' % table
+
+
+def _get_fragment(table, column, value):
+    """
+    Name given to the table key of the rows of ``table``
+    where ``column`` equals ``value``.
+    """
+    return '%s:%s=%s' % (table, column, value)
+
+
+def _get_column_fragment(table, column):
+    """
+    Name given to the table key of ``column`` of ``table``.
+    """
+    return '%s.%s' % (table, column)
+
+
+def _has_fragments(table):
+    return (table in cachalot_settings.CACHALOT_ROW_LEVEL_TABLES
+            or table in cachalot_settings.CACHALOT_PARTITION_COLUMNS
+            or table in cachalot_settings.CACHALOT_COLUMN_LEVEL_TABLES)
+
+
+@lru_cache(maxsize=None)
+def _get_table_columns(table):
+    columns = set()
+    for model in apps.get_models(include_auto_created=True):
+        meta = model._meta
+        if meta.db_table == table:
+            columns.update(f.column.lower()
+                           for f in meta.local_concrete_fields)
+    return frozenset(columns)
+
+
+def _get_fragment_fields(meta):
+    """
+    Returns the fields splitting the table of ``meta`` into fragments,
+    from the narrowest to the broadest.
+    """
+    table = meta.db_table
+    fields = []
+    if table in cachalot_settings.CACHALOT_ROW_LEVEL_TABLES:
+        fields.append(meta.pk)
+    column = cachalot_settings.CACHALOT_PARTITION_COLUMNS.get(table)
+    if column is not None:
+        fields.extend(f for f in meta.local_concrete_fields
+                      if f.column == column)
+    return fields
+
+
+def _get_lookup_values(query, field, lookup_classes):
+    """
+    Returns the values of ``field`` the rows of the main table
+    of ``query`` are restricted to by its WHERE clause, or ``None``
+    if no such restriction is found.
+    """
+    where = query.where
+    if where.connector != AND or where.negated:
+        return
+    table = query.get_meta().db_table
+    for child in where.children:
+        if not isinstance(child, lookup_classes):
+            continue
+        lhs = child.lhs
+        if lhs.__class__ is not Col or lhs.target != field:
+            continue
+        aliases = [alias for alias, join in query.alias_map.items()
+                   if join.table_name == table]
+        if aliases != [lhs.alias]:
+            return
+        values = child.rhs
+        if isinstance(child, Exact):
+            values = [values]
+        elif values.__class__ not in ITERABLES:
+            continue
+        if all(v.__class__ in FRAGMENT_VALUE_TYPES for v in values):
+            return list(values)
+
+
+def _get_read_fragments(query):
+    """
+    Returns the names of the fragments of its main table read by ``query``
+    if it only reads rows where a fragment field equals a single value,
+    otherwise returns ``None``.
+    """
+    model = query.model
+    if model is None:
+        return
+    meta = model._meta
+    fields = _get_fragment_fields(meta)
+    if not fields or isinstance(query, AggregateQuery) \
+            or query.combined_queries or query.extra_select:
+        return
+    # Subqueries may read other rows of the same table.
+    for annotation in query.annotations.values():
+        if isinstance(annotation, Subquery):
+            return
+    try:
+        for subquery in _find_subqueries_in_where(query.where.children):
+            return
+    except IsRawQuery:
+        return
+    for field in fields:
+        values = _get_lookup_values(query, field, Exact)
+        if values is not None:
+            table = meta.db_table
+            return [_get_whole_table(table),
+                    _get_fragment(table, field.column, values[0])]
+
+
+def _get_written_values(query, field):
+    """
+    Returns the values of ``field`` in the rows written by an insert,
+    update or delete ``query``, or ``None`` if they cannot be determined
+    before executing it.
+    """
+    if isinstance(query, InsertQuery):
+        values = [getattr(obj, field.attname) for obj in query.objs]
+        if not field.primary_key:
+            # These rows cannot be read by a fragment lookup.
+            values = [v for v in values if v is not None]
+        if all(v.__class__ in FRAGMENT_VALUE_TYPES for v in values):
+            return values
+        return
+    new_values = []
+    if isinstance(query, UpdateQuery):
+        for updated_field, model, value in query.values:
+            if updated_field == field:
+                # The rows also move to the fragment of the new value.
+                if field.primary_key \
+                        or value.__class__ not in FRAGMENT_VALUE_TYPES:
+                    return
+                new_values.append(value)
+    values = _get_lookup_values(query, field, (Exact, In))
+    if values is not None:
+        return values + new_values
+
+
+def _get_written_fragments(query):
+    """
+    Returns the names of the fragments written by an insert, update
+    or delete ``query``, or ``None`` if its table has no fragments.
+    Updates of ``CACHALOT_COLUMN_LEVEL_TABLES`` only write the fragments
+    of the updated columns.
+    """
+    meta = query.get_meta()
+    table = meta.db_table
+    fields = _get_fragment_fields(meta)
+    column_level = table in cachalot_settings.CACHALOT_COLUMN_LEVEL_TABLES
+    if not fields and not column_level:
+        return
+    fragments = set()
+    for field in fields:
+        values = _get_written_values(query, field)
+        if values is None:
+            fragments.add(_get_whole_table(table))
+        else:
+            fragments.update(_get_fragment(table, field.column, v)
+                             for v in values)
+    if column_level:
+        if isinstance(query, UpdateQuery):
+            fragments.update(_get_column_fragment(table, field.column)
+                             for field, model, value in query.values)
+        else:
+            # Inserted or deleted rows change the result of any query.
+            fragments.add(_get_whole_table(table))
+    return fragments
+
+
+def _get_prefetch_tables(model, lookups):
+    """
+    Returns the tables of the models found along ``prefetch_related``
+    ``lookups`` from ``model``, including the tables of many-to-many
+    relations.  Lookups going through generic relations or prefetch
+    attributes are followed as far as possible.
+    """
+    tables = set()
+    for lookup in lookups:
+        if isinstance(lookup, Prefetch):
+            lookup = lookup.prefetch_through
+        current_model = model
+        for part in lookup.split(LOOKUP_SEP):
+            try:
+                field = current_model._meta.get_field(part)
+            except FieldDoesNotExist:
+                break
+            related_model = field.related_model
+            if related_model is None:
+                break
+            if field.many_to_many:
+                through = getattr(field, 'through', None)
+                if through is None:
+                    through = field.remote_field.through
+                tables.add(through._meta.db_table)
+            tables.add(related_model._meta.db_table)
+            current_model = related_model
+    return tables
+
+
+def _get_split_lookup(compiler):
+    """
+    Returns the position in the WHERE clause of an ``__in`` lookup
+    the query of ``compiler`` can be split on, one result per value,
+    and the position in the result rows of the column it filters,
+    or ``None`` if the query cannot be split.
+    """
+    query = compiler.query
+    # Without a defined order, rows can be merged in any order.
+    if query.model is None or isinstance(query, AggregateQuery) \
+            or query.combined_queries or query.extra or query.extra_tables \
+            or query.distinct or query.group_by is not None \
+            or query.low_mark or query.high_mark is not None \
+            or query.order_by or query.extra_order_by \
+            or (query.default_ordering and query.get_meta().ordering):
+        return
+    for annotation in query.annotations.values():
+        if getattr(annotation, 'contains_aggregate', False):
+            return
+    where = query.where
+    if where.connector != AND or where.negated:
+        return
+    for position, child in enumerate(where.children):
+        if not isinstance(child, In) or child.lhs.__class__ is not Col \
+                or child.rhs.__class__ not in ITERABLES \
+                or len(child.rhs) < 2 \
+                or any(v.__class__ not in SPLIT_VALUE_TYPES
+                       for v in child.rhs):
+            continue
+        for index, (expression, sql, alias) in enumerate(compiler.select):
+            if expression.__class__ is Col \
+                    and expression.alias == child.lhs.alias \
+                    and expression.target == child.lhs.target:
+                return position, index
+
+
+def _get_split_cache_keys(compiler, position, hash_tag=''):
+    """
+    Returns a dict of the values of the ``__in`` lookup at ``position``
+    in the WHERE clause, mapped to the cache key of the rows
+    matching each of them, prefixed with ``hash_tag``.
+    """
+    query = compiler.query.clone()
+    lookup = query.where.children[position]
+    # The values are replaced to get a SQL query common to all values.
+    query.where.children[position] = IsNull(lookup.lhs, True)
+    sql, params = query.get_compiler(compiler.using).as_sql()
+    check_parameter_types(params)
+    prefix = '%s:%s:%s' % (compiler.using, sql, _encode_params(params))
+    # The position tells which lookup was replaced in this SQL.
+    return {
+        v: hash_tag + sha1(
+            ('%s:%d:%r' % (prefix, position, v)).encode('utf-8')).hexdigest()
+        for v in lookup.rhs}
+
+
+def _get_table_timeout(table):
+    return cachalot_settings.CACHALOT_TABLE_TIMEOUTS.get(
+        table, cachalot_settings.CACHALOT_TIMEOUT)
+
+
+def _get_shortest_timeout(timeouts):
+    """
+    Returns the shortest of ``timeouts``, ``None`` meaning no expiration.
+    """
+    timeouts = [t for t in timeouts if t is not None]
+    if timeouts:
+        return min(timeouts)
+
+
+def _get_timeouts(keys):
+    """
+    Returns a dict of the table cache keys of ``keys`` that do not use
+    ``CACHALOT_TIMEOUT``, mapped to their timeout.
+    """
+    table_timeouts = cachalot_settings.CACHALOT_TABLE_TIMEOUTS
+    if not table_timeouts:
+        return {}
+    return {k: table_timeouts[table] for k, table in keys.items()
+            if table in table_timeouts}
+
+
+def _set_many(cache, data, timeouts):
+    """
+    Sets ``data`` in ``cache`` with one ``set_many`` per timeout,
+    ``timeouts`` mapping the keys not using ``CACHALOT_TIMEOUT``
+    to their timeout.
+    """
+    default_timeout = cachalot_settings.CACHALOT_TIMEOUT
+    if not timeouts:
+        cache.set_many(data, default_timeout)
+        return
+    data_per_timeout = defaultdict(dict)
+    for k, v in data.items():
+        data_per_timeout[timeouts.get(k, default_timeout)][k] = v
+    for timeout, timeout_data in data_per_timeout.items():
+        cache.set_many(timeout_data, timeout)
+
+
 def _get_table_cache_keys(compiler):
+    """
+    Returns a dict of the table cache keys a query depends on,
+    mapped to their tables.
+    """
     db_alias = compiler.using
     get_table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN
-    return [get_table_cache_key(db_alias, t)
-            for t in _get_tables(db_alias, compiler.query)]
+    query = compiler.query
+    tables = _get_tables(db_alias, query)
+    table_cache_keys = {}
+    fragments = _get_read_fragments(query)
+    if fragments is not None:
+        table = query.get_meta().db_table
+        tables.discard(table)
+        table_cache_keys.update(
+            (get_table_cache_key(db_alias, f), table) for f in fragments)
+    column_level_tables = [
+        t for t in cachalot_settings.CACHALOT_COLUMN_LEVEL_TABLES
+        .intersection(tables) if _get_table_columns(t)]
+    if column_level_tables:
+        # Like for raw queries, columns are searched in the SQL query,
+        # which may give false positives but no false negative.
+        sql = compiler.as_sql()[0].lower()
+        for table in column_level_tables:
+            tables.discard(table)
+            fragments = [_get_whole_table(table)]
+            fragments.extend(_get_column_fragment(table, column)
+                             for column in _get_table_columns(table)
+                             if column in sql)
+            table_cache_keys.update(
+                (get_table_cache_key(db_alias, f), table) for f in fragments)
+    table_cache_keys.update(
+        (get_table_cache_key(db_alias, t), t) for t in tables)
+    return table_cache_keys
+
+
+def _get_table_invalidation_keys(db_alias, tables):
+    """
+    Returns a dict of the cache keys to invalidate when writing ``tables``
+    without knowing which rows, mapped to their tables.
+    """
+    get_table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN
+    keys = {get_table_cache_key(db_alias, t): t for t in tables}
+    for table in tables:
+        if _has_fragments(table):
+            keys[get_table_cache_key(db_alias,
+                                     _get_whole_table(table))] = table
+    return keys
 
 
-def _invalidate_tables(cache, db_alias, tables):
-    tables = filter_cachable(set(tables))
-    if not tables:
+def _get_fragment_invalidation_keys(db_alias, table, fragments):
+    """
+    Returns a dict of the cache keys to invalidate when writing
+    ``fragments`` of ``table``, mapped to this table.
+    """
+    get_table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN
+    keys = {get_table_cache_key(db_alias, f): table for f in fragments}
+    keys[get_table_cache_key(db_alias, table)] = table
+    return keys
+
+
+def _invalidate_cache_keys(cache, keys):
+    if not keys:
         return
     now = time()
-    get_table_cache_key = cachalot_settings.CACHALOT_TABLE_KEYGEN
-    cache.set_many(
-        {get_table_cache_key(db_alias, t): now for t in tables},
-        cachalot_settings.CACHALOT_TIMEOUT)
+    _set_many(cache, {k: now for k in keys}, _get_timeouts(keys))
 
     if isinstance(cache, AtomicCache):
-        cache.to_be_invalidated.update(tables)
+        cache.add_to_be_invalidated(keys)
+
+
+def _invalidate_tables(cache, db_alias, tables):
+    _invalidate_cache_keys(cache, _get_table_invalidation_keys(
+        db_alias, filter_cachable(set(tables))))